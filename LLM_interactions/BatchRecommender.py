@@ -0,0 +1,145 @@
+import asyncio
+import logging
+import random
+import time
+
+from app_requests.Metrics import METRICS
+from vector_database.Candidates import Candidates
+
+logger = logging.getLogger(__name__)
+
+
+class BatchRecommender:
+    """Computes the recommendations of many users at once, e.g. to refresh everyone before a morning push,
+    yielding every user's result as soon as it is ready.
+
+    Users run concurrently through the usual pipeline, so topic and ranking GPT calls fan out up to the
+    LLMClient's concurrency limit while the blocking Chroma work spreads over the default executor.
+    The retrieval stage is shared across the batch: each distinct topic is embedded and queried once, topics
+    that come in together go out in a single Chroma query, and users without topics draw from one random pool.
+    Build one per batch, the shared pools are not refreshed while it lives.
+
+    Args:
+        recommender_factory (callable): returns a GPTRecommender on the shared resources, e.g. AppResources.recommender
+        news_vector_storage (NewsVectorStorage): shared vector storage
+        recommendation_store (RecommendationStore, optional): results are stored there, so the users' next requests
+            are served from it. Computed directly without storing when None.
+        max_users_in_flight (int, optional): users processed at once, bounds memory on large batches. Defaults to 64.
+        articles_limit (int, optional): candidates per user. Defaults to 30.
+        mmr_lambda (float, optional): MMR re-ranking of the candidates, as for single requests. Defaults to 0.7.
+        oversample (float, optional): see NewsVectorStorage.query_topics. Defaults to 1.5.
+        random_pool_size (int, optional): random articles shared by the users without topics. Defaults to 200.
+    """
+    def __init__(self, recommender_factory, news_vector_storage, recommendation_store=None, max_users_in_flight=64,
+                 articles_limit=30, mmr_lambda=0.7, oversample=1.5, random_pool_size=200) -> None:
+        self._recommender_factory = recommender_factory
+        self._news_vector_storage = news_vector_storage
+        self._recommendation_store = recommendation_store
+        self._users_in_flight = asyncio.Semaphore(max_users_in_flight)
+        self._articles_limit = articles_limit
+        self._mmr_lambda = mmr_lambda
+        self._oversample = oversample
+        self._random_pool_size = random_pool_size
+        self._topic_results = {}
+        self._pending_topics = []
+        self._random_pool = None
+
+    def _topic_result(self, topic: str) -> asyncio.Future:
+        """Future of the query results of one topic, queried once per batch"""
+        future = self._topic_results.get(topic)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            future = self._topic_results[topic] = loop.create_future()
+            self._pending_topics.append(topic)
+            if len(self._pending_topics) == 1:
+                # topics requested within the same event loop iteration share one Chroma query
+                loop.call_soon(self._flush_pending_topics)
+        return future
+
+    def _flush_pending_topics(self) -> None:
+        topics, self._pending_topics = self._pending_topics, []
+        asyncio.ensure_future(self._query_topics(topics))
+
+    async def _query_topics(self, topics: list) -> None:
+        try:
+            # the largest k any user can need, every user then cuts its own k off the top
+            results = await asyncio.to_thread(self._query_topic_results, topics)
+        except Exception as e:
+            for topic in topics:
+                self._topic_results[topic].set_exception(e)
+            return
+        METRICS.inc('batch_topic_queries_total')
+        for index, topic in enumerate(topics):
+            self._topic_results[topic].set_result({key: [values[index]] for key, values in results.items()
+                                                   if key in ('ids', 'distances', 'metadatas', 'embeddings') and values is not None})
+
+    def _query_topic_results(self, topics: list) -> dict:
+        per_topic_k = self._news_vector_storage.per_topic_k(1, self._articles_limit, self._oversample)
+        if per_topic_k == 0:
+            return {'ids': [[] for _ in topics], 'distances': [[] for _ in topics], 'metadatas': [[] for _ in topics]}
+        return self._news_vector_storage.query_topic_results(topics, per_topic_k)
+
+    def _candidates_from_topic_results(self, topic_results: list) -> Candidates:
+        per_topic_k = self._news_vector_storage.per_topic_k(len(topic_results), self._articles_limit, self._oversample)
+        results = {key: [result[key][0][:per_topic_k] for result in topic_results] for key in topic_results[0]}
+        return self._news_vector_storage.candidates_from_topic_results(results, self._articles_limit, self._mmr_lambda)
+
+    async def _random_candidates(self) -> Candidates:
+        if self._random_pool is None:
+            self._random_pool = asyncio.ensure_future(asyncio.to_thread(self._news_vector_storage.query_random, self._random_pool_size))
+        # shielded, one cancelled user must not cancel the pool of the others
+        pool = await asyncio.shield(self._random_pool)
+        return pool.take(random.sample(range(len(pool)), min(self._articles_limit, len(pool))))
+
+    async def _get_candidates(self, recommender, user_id: str) -> Candidates:
+        """Same candidates as GPTRecommender.get_candidates, retrieved through the batch's shared pools"""
+        with METRICS.span('topics'):
+            topics = await recommender.get_topics(user_id)
+        topics = list(dict.fromkeys(topics["topics_of_interest"]))
+        if len(topics) == 0:
+            return await self._random_candidates()
+        topic_results = await asyncio.gather(*(asyncio.shield(self._topic_result(topic)) for topic in topics))
+        return await asyncio.to_thread(self._candidates_from_topic_results, topic_results)
+
+    async def _compute(self, user_id: str) -> dict:
+        recommender = self._recommender_factory()
+        return await recommender.get_recommendations(
+            user_id, get_candidates=lambda user_id: self._get_candidates(recommender, user_id))
+
+    async def _recommend_user(self, user_id: str, force: bool) -> dict:
+        async with self._users_in_flight:
+            try:
+                if self._recommendation_store is not None:
+                    recommendations = await self._recommendation_store.refresh(user_id, compute=self._compute, force=force)
+                else:
+                    recommendations = await self._compute(user_id)
+            except Exception as e:
+                logger.error(f"Batch recommendations of user {user_id} failed: {e!r}")
+                METRICS.inc('batch_users_total', outcome='error')
+                return {"user_id": user_id, "error": str(e)}
+        METRICS.inc('batch_users_total', outcome='success')
+        return {"user_id": user_id, "recommendations": recommendations}
+
+    async def stream(self, user_ids: list, force=False):
+        """Computes the recommendations of all users, yielding them in completion order.
+
+        Args:
+            user_ids (list): IDs of the users, duplicates are computed once.
+            force (bool, optional): recomputes the stored recommendations that are still fresh too. Defaults to False.
+
+        Yields:
+            dict: {"user_id": ..., "recommendations": ...}, or {"user_id": ..., "error": ...} when that user failed
+        """
+        started = time.perf_counter()
+        tasks = [asyncio.ensure_future(self._recommend_user(user_id, force)) for user_id in dict.fromkeys(user_ids)]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                yield await next_done
+        finally:
+            # the consumer went away (e.g. the client disconnected), stop the remaining users
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            elapsed = time.perf_counter() - started
+            logger.info(f"Batch of {len(tasks)} users done in {elapsed:.1f}s, "
+                        f"{len(self._topic_results)} distinct topics queried")
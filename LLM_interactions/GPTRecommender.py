@@ -1,33 +1,54 @@
-from openai import OpenAI
-import json
+import asyncio
+from LLM_interactions.LLMClient import LLMClient
+from LLM_interactions.Ranker import GPTRanker
+from app_requests.Metrics import METRICS
+from vector_database.Candidates import Candidates
 from vector_database.NewsVectorStorage import NewsVectorStorage
-import pandas as pd
 import os
 import logging
+import time
 import numpy as np
 
+logger = logging.getLogger(__name__)
+
+METRICS.describe('stream_first_article_seconds', 'Time from the start of a streamed recommendation request to its first article')
+
+
 class GPTRecommender:
     """Class for interacting with OpenAI's GPT API for generating recommendations
+    Cheap to construct per request, the client and the vector storage are shared application resources.
+    The pipeline is async: LLM calls go through the shared LLMClient, blocking Chroma and SQLite work
+    runs in the default executor, so a request never holds a thread while waiting for GPT.
+
     Args:
         template_constructor (RecommendationTemplateConstructor): object for constructing prompts for GPT
+        llm_client (LLMClient, optional): shared async GPT client. A new one is created when None.
+        news_vector_storage (NewsVectorStorage, optional): shared vector storage. A new one is created when None.
+        topic_cache (TopicCache, optional): shared cache of the topics GPT derived per user. No caching when None.
+        ranker (Ranker, optional): ranking stage. Defaults to GPTRanker, GPT picking out of all candidates.
     """
-    def __init__(self, template_constructor) -> None:
-        self._client = OpenAI()
+    def __init__(self, template_constructor, llm_client=None, news_vector_storage=None, topic_cache=None, ranker=None) -> None:
+        self._topic_cache = topic_cache
+        self._llm_client = llm_client if llm_client is not None else LLMClient()
+        self._ranker = ranker if ranker is not None else GPTRanker(self._llm_client)
         self._template_constructor = template_constructor
         self._current_candidates = None
-        self._log_filename = "logs.log"
-        
-        self.logger = logging.getLogger(__name__)
-        self.logger.setLevel(logging.DEBUG)
+        self.logger = logger
+        self.news_vector_storage = news_vector_storage if news_vector_storage is not None else NewsVectorStorage()
+
+    def _get_cached_topics(self, user_id: str):
+        """Reads the topics prompt inputs and looks them up in the topic cache.
 
-        self.news_vector_storage = NewsVectorStorage()
-        fh = logging.FileHandler(self._log_filename)
-        fh.setLevel(logging.DEBUG)
-        formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-        fh.setFormatter(formatter)
-        self.logger.addHandler(fh)
+        Returns:
+            tuple: (prompt_inputs, fingerprint, topics) where topics is None on a cache miss
+        """
+        prompt_inputs = self._template_constructor.get_topics_prompt_inputs(user_id)
+        if self._topic_cache is None:
+            return prompt_inputs, None, None
+        fingerprint = self._topic_cache.fingerprint(prompt_inputs["articles"], prompt_inputs["preferences"])
+        return prompt_inputs, fingerprint, self._topic_cache.get(user_id, fingerprint)
 
-    def get_topics(self, user_id: str) -> dict:
+    async def get_topics(self, user_id: str) -> dict:
         """
         Retrieves topics of interest for a given user.
 
@@ -37,22 +58,21 @@ class GPTRecommender:
         Returns:
             dict: A dictionary with one key containing the topics if interest like topics_of_interest: ['Topic1', 'Topic'...]
         """
+        prompt_inputs, fingerprint, topics = await asyncio.to_thread(self._get_cached_topics, user_id)
+        if topics is not None:
+            self.logger.info(f"Topics for user {user_id} served from cache: {topics}")
+            return topics
+
         prompt = self._template_constructor.construct_getting_topics_prompt(
-            user_id)
-        self.logger.info(f"Prompt to get topics: {prompt}")
+            user_id, prompt_inputs)
+        self.logger.debug("Prompt to get topics: %s", prompt)
         
-        response = self._client.chat.completions.create(
-            model="gpt-4-turbo-preview",
-            response_format={"type": "json_object"},
-            temperature=0.1,
-            messages=[
-                {"role": "user", "content": prompt}
-            ]
-        )
-        self.logger.info(f"Response from GPT for topics: {response}")
-        return json.loads(response.choices[0].message.content)
+        topics = await self._llm_client.complete_json(prompt)
+        if self._topic_cache is not None:
+            self._topic_cache.put(user_id, fingerprint, topics)
+        return topics
     
-    def get_candidates(self, user_id: str) -> pd.DataFrame:
+    async def get_candidates(self, user_id: str) -> Candidates:
         """
         Retrieves a dictionary of news articles that are potential candidates for recommendation based on the user's topics of interest.
 
@@ -60,78 +80,103 @@ class GPTRecommender:
             user_id (str): The ID of the user.
 
         Returns:
-            pd.DataFrame: A DataFrame containing the potential candidates for recommendation (max 30 nearest)
+            Candidates: The potential candidates for recommendation (max 30 nearest)
         """
-        topics = self.get_topics(user_id)
+        with METRICS.span('topics'):
+            topics = await self.get_topics(user_id)
         topics = topics["topics_of_interest"]
         
         # handle the case when there are no user preferences yet
         if len(topics) == 0:
-            random_articles = self.news_vector_storage.query_random()
+            random_articles = await asyncio.to_thread(self.news_vector_storage.query_random)
             return random_articles
         
-        news_df = self.news_vector_storage.query_topics(topics)
+        # MMR keeps users with many overlapping topics from getting the same story over and over
+        news_df = await asyncio.to_thread(self.news_vector_storage.query_topics, topics, mmr_lambda=0.7)
         return news_df
     
-    def get_random_diversified_candidates(self, recommended_titles: pd.DataFrame) -> pd.DataFrame:
+    def get_random_diversified_candidates(self, recommended_titles: Candidates) -> Candidates:
         """
-        Returns a DataFrame containing a combination of recommended titles and randomly selected articles.
+        Returns a combination of recommended titles and randomly selected articles.
 
         Parameters:
-        recommended_titles (pd.DataFrame): A DataFrame containing the recommended titles.
+        recommended_titles (Candidates): The recommended titles.
 
         Returns:
-        pd.DataFrame: A DataFrame containing a combination of recommended titles and randomly selected articles.
+        Candidates: The recommended titles followed by randomly selected articles.
         """
-        random_articles = self.news_vector_storage.query_random(5, ids_to_exclude=recommended_titles["link"].tolist())
-        random_articles["explanations"] = "We thought you might like these articles as well."
-        return pd.concat([recommended_titles, random_articles], ignore_index=True)
+        random_articles = self._get_random_diversification(recommended_titles.link)
+        return recommended_titles.concat(random_articles)
+
+    def _get_random_diversification(self, recommended_links: list) -> Candidates:
+        random_articles = self.news_vector_storage.query_random(5, ids_to_exclude=recommended_links)
+        return random_articles.with_explanations("We thought you might like these articles as well.")
         
     
-    def get_recommended_titles(self, user_id: str, candidates: pd.DataFrame) -> dict:
+    async def get_recommended_titles(self, user_id: str, candidates: Candidates) -> dict:
         """
-        Ranking part. Retrieves recommended titles for a given user and candidates DataFrame.
+        Ranking part. Retrieves recommended titles for a given user and candidates.
 
         Args:
             user_id (str): The ID of the user.
-            candidates (pd.DataFrame): The DataFrame containing the candidate titles.
+            candidates (Candidates): The candidate articles.
 
         Returns:
-            dict: A dictionary containing the recommended titles.
+            dict: A dictionary with the IDs of the recommended candidates (1-based positions in candidates) and the explanations.
 
         """
         self._current_candidates = candidates
-        prompt = self._template_constructor.construct_recommendation_prompt(
-            user_id, candidates)
-        response = self._client.chat.completions.create(
-            model="gpt-4-turbo-preview",
-            response_format={"type": "json_object"},
-            temperature=0.1,
-            messages=[
-                {"role": "user", "content": prompt}
-            ]
-        )
-        return json.loads(response.choices[0].message.content)
+        return await self._ranker.rank(user_id, candidates, self._template_constructor)
     
-    def prepare_response_json(self, recommended_titles: pd.DataFrame, explanations: list) -> dict:
+    def prepare_response_json(self, recommended_titles: Candidates, explanations: list) -> dict:
         """
         Used after ranking. Prepares the response JSON object with recommended titles and adds random.
 
         Args:
-            recommended_titles (pd.DataFrame): A DataFrame containing the recommended titles.
+            recommended_titles (Candidates): The recommended titles.
             explanations (list): A list of explanations for the recommended titles.
 
         Returns:
             dict: The response JSON object with recommended titles and explanations.
         """
-        recommended_titles.drop_duplicates(subset=['title'], inplace=True)
-        self.logger.info(f"Recommended titles DF in prepare_response_json: {recommended_titles}")
-        self.logger.info(f"Explanations in prepare_response_json: {explanations}")
-        recommended_titles["explanations"] = explanations
-        recommended_titles = self.get_random_diversified_candidates(recommended_titles)
-        response = {key: list(value.values()) for key, value in recommended_titles.to_dict().items()}
-        return response
+        self.logger.debug("Recommended titles in prepare_response_json: %s", recommended_titles)
+        self.logger.debug("Explanations in prepare_response_json: %s", explanations)
+        # explanations are set before dropping duplicates, so every one stays next to its own article
+        recommended_titles = recommended_titles.with_explanations(explanations).dedupe('title')
+        return self.get_random_diversified_candidates(recommended_titles).to_payload()
     
+    @staticmethod
+    def _select_recommended(candidates: Candidates, ids: list, explanations: list):
+        """
+        Maps the ranker's answer back to candidate rows by ID, in the ranker's order and with every explanation next to its own article.
+        IDs that are not valid candidate positions, and repeated articles, are dropped together with their explanation.
+
+        Returns:
+            tuple: (Candidates recommended, list of their explanations)
+        """
+        positions, picked_titles, picked_explanations = [], set(), []
+        for id, explanation in zip(ids, explanations):
+            position = GPTRecommender._pick_position(candidates, id, picked_titles)
+            if position is not None:
+                positions.append(position)
+                picked_explanations.append(explanation)
+        return candidates.take(positions), picked_explanations
+
+    @staticmethod
+    def _pick_position(candidates: Candidates, id, picked_titles: set):
+        """Position of the candidate with the given ID, None when the ID is invalid or its title was already picked"""
+        try:
+            position = int(id) - 1
+        except (TypeError, ValueError):
+            return None
+        if not 0 <= position < len(candidates):
+            return None
+        title = candidates.title[position]
+        if title in picked_titles:
+            return None
+        picked_titles.add(title)
+        return position
+
     def _check_whether_user_is_new(self, user_id: str) -> None:
         """
         Checks whether the user is new by verifying the existence of the user preferences file.
@@ -147,25 +192,61 @@ class GPTRecommender:
             with open(f'LLM_interactions/UserPreferences/{user_id}.txt', 'w') as file:
                 file.write("")
     
-    def get_recommendations(self, user_id: str) -> pd.DataFrame:
+    async def get_recommendations(self, user_id: str, get_candidates=None) -> dict:
         """
         The orchestrator function. Retrieves recommendations for a given user.
 
         Args:
             user_id (str): The ID of the user.
+            get_candidates (callable, optional): coroutine function user_id -> Candidates replacing the
+                retrieval stage, e.g. the batch recommender's shared candidate pools. Defaults to self.get_candidates.
 
         Returns:
             dict: A dictionary containing the recommended titles. Represents the response JSON object that we return to the client.
         """
-        self._check_whether_user_is_new(user_id)
-        candidates = self.get_candidates(user_id)
-        recommended_json = self.get_recommended_titles(user_id, candidates)
-        recommended_titles = recommended_json["candidates"]
-        response = self.prepare_response_json(self._current_candidates[self._current_candidates['title'].isin(recommended_titles)], recommended_json["explanations"])
-        self.logger.info(f"Response from GPT for recommendations: {response}")
+        await asyncio.to_thread(self._check_whether_user_is_new, user_id)
+        candidates = await (get_candidates or self.get_candidates)(user_id)
+        with METRICS.span('ranking'):
+            recommended_json = await self.get_recommended_titles(user_id, candidates)
+        with METRICS.span('postprocessing'):
+            recommended_titles, explanations = self._select_recommended(self._current_candidates, recommended_json.get("ids", []), recommended_json.get("explanations", []))
+            response = await asyncio.to_thread(self.prepare_response_json, recommended_titles, explanations)
+        self.logger.debug("Response from GPT for recommendations: %s", response)
         return response
     
-    def adjust_recommendations(self, user_id: str, request: str) -> dict:
+    async def stream_recommendations(self, user_id: str):
+        """
+        Streaming variant of get_recommendations. Yields the recommended articles one by one, each as soon as the
+        ranker completed its ID and explanation, joined to the candidate's stored metadata. The random
+        diversification articles come last.
+
+        Args:
+            user_id (str): The ID of the user.
+
+        Yields:
+            dict: one article, with the same fields as a column of the get_recommendations response
+        """
+        started = time.perf_counter()
+        await asyncio.to_thread(self._check_whether_user_is_new, user_id)
+        candidates = await self.get_candidates(user_id)
+        picked_titles, recommended_links = set(), []
+        with METRICS.span('ranking'):
+            async for id, explanation in self._ranker.rank_stream(user_id, candidates, self._template_constructor):
+                position = self._pick_position(candidates, id, picked_titles)
+                if position is None:
+                    continue
+                if not recommended_links:
+                    METRICS.observe('stream_first_article_seconds', time.perf_counter() - started)
+                article = candidates.row(position)
+                article["explanations"] = explanation
+                recommended_links.append(article["link"])
+                yield article
+        with METRICS.span('postprocessing'):
+            random_articles = await asyncio.to_thread(self._get_random_diversification, recommended_links)
+        for article in random_articles.rows():
+            yield article
+
+    async def adjust_recommendations(self, user_id: str, request: str) -> dict:
         """Adjust recommendations based on user feedback.
         
         Args:
@@ -178,21 +259,15 @@ class GPTRecommender:
         
         prompt = self._template_constructor.construct_recommendation_adjustment_prompt(
             user_id, request)
-        self.logger.info(f"Prompt to adjust recommendations: {prompt}")
-        response = self._client.chat.completions.create(
-            model="gpt-4-turbo-preview",
-            response_format={"type": "json_object"},
-            temperature=0.1,
-            messages=[
-                {"role": "user", "content": prompt}
-            ]
-        )
-        adjusted_recommendation = json.loads(response.choices[0].message.content)
-        self.logger.info(f"Adjusted recommendation: {adjusted_recommendation}")
+        self.logger.debug("Prompt to adjust recommendations: %s", prompt)
+        adjusted_recommendation = await self._llm_client.complete_json(prompt)
+        self.logger.debug("Adjusted recommendation: %s", adjusted_recommendation)
         
         if adjusted_recommendation["preferences"] is not None:
             with open(f'LLM_interactions/UserPreferences/{user_id}.txt', 'w') as file:
                 file.write(adjusted_recommendation["preferences"])
                 self.logger.info(f"!!! Updated preferences for user {user_id}: {adjusted_recommendation['preferences']}")
                 self.logger.info(f'LLM_interactions/UserPreferences/{user_id}.txt')
+            if self._topic_cache is not None:
+                self._topic_cache.invalidate(user_id)
         return adjusted_recommendation
\ No newline at end of file
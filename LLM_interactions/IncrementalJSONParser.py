@@ -0,0 +1,89 @@
+import json
+
+
+class IncrementalJSONParser:
+    """Parses a JSON object that arrives in pieces, e.g. a streamed GPT answer like {"ids": [...], "explanations": [...]},
+    and hands out every element of its top-level arrays as soon as the element is complete.
+
+    Only the characters of the current element are buffered, each element is decoded once with json.loads.
+    Anything around the object, like a Markdown code fence, is ignored. Values of the object that are not arrays
+    are skipped.
+
+    Usage:
+        parser = IncrementalJSONParser()
+        for chunk in chunks:
+            for key, value in parser.feed(chunk):
+                ...
+    """
+    def __init__(self) -> None:
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+        self._expecting_key = False
+        self._key_chars = None
+        self._key = None
+        self._array_key = None
+        self._element_chars = None
+
+    def _finish_element(self, events: list) -> None:
+        text = ''.join(self._element_chars).strip()
+        if text:
+            events.append((self._array_key, json.loads(text)))
+        self._element_chars = []
+
+    def feed(self, chunk: str) -> list:
+        """Consumes the next piece of the answer.
+
+        Returns:
+            list: (key, element) pairs completed by this piece, key being the name of the array the element belongs to
+        """
+        events = []
+        for char in chunk:
+            if self._in_string:
+                if self._key_chars is not None:
+                    self._key_chars.append(char)
+                elif self._element_chars is not None:
+                    self._element_chars.append(char)
+                if self._escaped:
+                    self._escaped = False
+                elif char == '\\':
+                    self._escaped = True
+                elif char == '"':
+                    self._in_string = False
+                    if self._key_chars is not None:
+                        self._key = json.loads(''.join(self._key_chars))
+                        self._key_chars = None
+                continue
+
+            if char == '"':
+                self._in_string = True
+                if self._depth == 1 and self._expecting_key:
+                    self._key_chars = [char]
+                elif self._element_chars is not None:
+                    self._element_chars.append(char)
+            elif char in '{[':
+                self._depth += 1
+                if self._depth == 1:
+                    self._expecting_key = True
+                elif self._depth == 2 and char == '[':
+                    self._array_key = self._key
+                    self._element_chars = []
+                elif self._element_chars is not None:
+                    self._element_chars.append(char)
+            elif char in '}]':
+                if self._depth == 2 and self._array_key is not None:
+                    self._finish_element(events)
+                    self._array_key = self._element_chars = None
+                elif self._element_chars is not None:
+                    self._element_chars.append(char)
+                self._depth -= 1
+            elif char == ',' and self._depth <= 2:
+                if self._depth == 2 and self._array_key is not None:
+                    self._finish_element(events)
+                elif self._depth == 1:
+                    self._expecting_key = True
+            elif char == ':' and self._depth == 1:
+                self._expecting_key = False
+            elif self._element_chars is not None:
+                self._element_chars.append(char)
+        return events
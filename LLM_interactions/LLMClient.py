@@ -0,0 +1,128 @@
+import asyncio
+import json
+import logging
+import random
+
+import httpx
+from openai import AsyncOpenAI, APIConnectionError, APITimeoutError, InternalServerError, RateLimitError
+
+from app_requests.Metrics import METRICS
+
+logger = logging.getLogger(__name__)
+
+RETRYABLE_ERRORS = (APIConnectionError, APITimeoutError, InternalServerError, RateLimitError, asyncio.TimeoutError)
+
+
+class LLMClient:
+    """Async access to GPT shared by the whole application.
+
+    One AsyncOpenAI client keeps a single connection pool, a global semaphore caps the LLM calls in flight
+    across all requests, every call has its own timeout and transient failures are retried with
+    exponential backoff and full jitter.
+
+    Args:
+        model (str, optional): chat model. Defaults to "gpt-4-turbo-preview".
+        max_concurrency (int, optional): maximum LLM calls in flight at once. Defaults to 16.
+        timeout (float, optional): seconds allowed for one call. Defaults to 60.
+        max_retries (int, optional): retries after the first attempt. Defaults to 3.
+        backoff_base (float, optional): first backoff ceiling in seconds, doubled on every retry. Defaults to 0.5.
+        base_url (str, optional): OpenAI-compatible endpoint, e.g. a local stub server. Defaults to the OpenAI API.
+        api_key (str, optional): API key. Read from OPENAI_API_KEY when None.
+    """
+    def __init__(self, model="gpt-4-turbo-preview", max_concurrency=16, timeout=60.0, max_retries=3,
+                 backoff_base=0.5, base_url=None, api_key=None) -> None:
+        self.model = model
+        self._timeout = timeout
+        self._max_retries = max_retries
+        self._backoff_base = backoff_base
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        # retries are handled here, with jitter, so the SDK must not retry on its own
+        self._client = AsyncOpenAI(base_url=base_url, api_key=api_key, max_retries=0, timeout=timeout,
+                                   http_client=httpx.AsyncClient(limits=httpx.Limits(max_connections=max_concurrency,
+                                                                                     max_keepalive_connections=max_concurrency)))
+
+    async def complete(self, prompt: str, **kwargs):
+        """Sends one user prompt and returns the raw chat completion"""
+        with METRICS.span('llm_call'):
+            for attempt in range(self._max_retries + 1):
+                try:
+                    with METRICS.span('llm_wait'):
+                        await self._semaphore.acquire()
+                    try:
+                        response = await asyncio.wait_for(
+                            self._client.chat.completions.create(
+                                model=self.model,
+                                messages=[{"role": "user", "content": prompt}],
+                                **kwargs),
+                            timeout=self._timeout)
+                    finally:
+                        self._semaphore.release()
+                    break
+                except RETRYABLE_ERRORS as e:
+                    if attempt == self._max_retries:
+                        METRICS.inc('llm_calls_total', outcome='failed')
+                        raise
+                    METRICS.inc('llm_retries_total', error=e.__class__.__name__)
+                    delay = random.uniform(0, self._backoff_base * 2 ** attempt)
+                    logger.warning(f"LLM call failed ({e.__class__.__name__}), retrying in {delay:.2f}s")
+                    await asyncio.sleep(delay)
+        METRICS.inc('llm_calls_total', outcome='ok')
+        if response.usage is not None:
+            METRICS.inc('llm_tokens_total', response.usage.prompt_tokens, type='prompt')
+            METRICS.inc('llm_tokens_total', response.usage.completion_tokens, type='completion')
+        return response
+
+    async def stream(self, prompt: str, **kwargs):
+        """Sends one user prompt and yields the text of the answer piece by piece, as it is generated.
+        Failures until the stream is open are retried like in complete; the concurrency slot is held until the
+        stream is consumed or closed, since the call is in flight all along."""
+        with METRICS.span('llm_call'):
+            for attempt in range(self._max_retries + 1):
+                with METRICS.span('llm_wait'):
+                    await self._semaphore.acquire()
+                try:
+                    stream = await asyncio.wait_for(
+                        self._client.chat.completions.create(
+                            model=self.model,
+                            messages=[{"role": "user", "content": prompt}],
+                            stream=True,
+                            **kwargs),
+                        timeout=self._timeout)
+                    break
+                except RETRYABLE_ERRORS as e:
+                    self._semaphore.release()
+                    if attempt == self._max_retries:
+                        METRICS.inc('llm_calls_total', outcome='failed')
+                        raise
+                    METRICS.inc('llm_retries_total', error=e.__class__.__name__)
+                    delay = random.uniform(0, self._backoff_base * 2 ** attempt)
+                    logger.warning(f"LLM call failed ({e.__class__.__name__}), retrying in {delay:.2f}s")
+                    await asyncio.sleep(delay)
+                except BaseException:
+                    self._semaphore.release()
+                    raise
+            try:
+                async for chunk in stream:
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        yield chunk.choices[0].delta.content
+            except Exception:
+                # a retry would repeat what was already handed out, the caller decides
+                METRICS.inc('llm_calls_total', outcome='failed')
+                raise
+            finally:
+                await stream.close()
+                self._semaphore.release()
+        METRICS.inc('llm_calls_total', outcome='ok')
+
+    def stream_json(self, prompt: str):
+        """Sends one user prompt in JSON mode and yields the raw answer text as it is generated, see IncrementalJSONParser"""
+        return self.stream(prompt, response_format={"type": "json_object"}, temperature=0.1)
+
+    async def complete_json(self, prompt: str) -> dict:
+        """Sends one user prompt in JSON mode and returns the parsed answer"""
+        response = await self.complete(prompt, response_format={"type": "json_object"}, temperature=0.1)
+        logger.debug("Response from GPT: %s", response)
+        return json.loads(response.choices[0].message.content)
+
+    async def close(self) -> None:
+        await self._client.close()
@@ -0,0 +1,201 @@
+import asyncio
+import logging
+import time
+from abc import ABC, abstractmethod
+
+import numpy as np
+import pandas as pd
+
+from LLM_interactions.IncrementalJSONParser import IncrementalJSONParser
+from vector_database.Candidates import Candidates
+
+logger = logging.getLogger(__name__)
+
+NO_SIGNAL_EXPLANATION = "We know little about you. Please provide your preferences in the chat."
+
+
+class Ranker(ABC):
+    """Ranking stage interface: picks the articles to recommend out of the retrieved candidates.
+
+    rank returns the same shape GPT answers with, {"ids": [candidate IDs], "explanations": [texts]}, best first.
+    A candidate's ID is its 1-based position in the candidates, as numbered in the prompts.
+    rank_stream yields the same answer one (ID, explanation) pair at a time, as soon as each pair is known.
+    """
+    @abstractmethod
+    async def rank(self, user_id: str, candidates: Candidates, template_constructor) -> dict:
+        """Returns {"ids": [candidate IDs], "explanations": [texts]}, best first"""
+
+    async def rank_stream(self, user_id: str, candidates: Candidates, template_constructor):
+        # rankers without a streamed answer hand out the whole ranking at once
+        ranked = await self.rank(user_id, candidates, template_constructor)
+        for id, explanation in zip(ranked.get("ids", []), ranked.get("explanations", [])):
+            yield id, explanation
+
+
+async def _stream_arrays(llm_client, prompt: str):
+    """Streams a JSON answer of GPT, yielding (key, element) for every element of its top-level arrays once complete"""
+    parser = IncrementalJSONParser()
+    async for text in llm_client.stream_json(prompt):
+        for key, element in parser.feed(text):
+            yield key, element
+
+
+class GPTRanker(Ranker):
+    """Sends every candidate title to GPT and lets it pick and explain the recommendations.
+
+    Args:
+        llm_client (LLMClient): shared async GPT client
+    """
+    def __init__(self, llm_client) -> None:
+        self._llm_client = llm_client
+
+    async def rank(self, user_id: str, candidates: Candidates, template_constructor) -> dict:
+        prompt = await asyncio.to_thread(template_constructor.construct_recommendation_prompt,
+                                         user_id, candidates)
+        return await self._llm_client.complete_json(prompt)
+
+    async def rank_stream(self, user_id: str, candidates: Candidates, template_constructor):
+        prompt = await asyncio.to_thread(template_constructor.construct_recommendation_prompt,
+                                         user_id, candidates)
+        ids, explanations = [], []
+        # an article is complete once both its ID and its explanation arrived, whichever array GPT writes first
+        async for key, element in _stream_arrays(self._llm_client, prompt):
+            if key == "ids":
+                ids.append(element)
+                completed = len(ids) <= len(explanations)
+            elif key == "explanations":
+                explanations.append(element)
+                completed = len(explanations) <= len(ids)
+            else:
+                continue
+            if completed:
+                index = len(ids if key == "ids" else explanations) - 1
+                yield ids[index], explanations[index]
+
+
+class EmbeddingRanker(Ranker):
+    """Ranks the candidates locally, by cosine similarity to a profile vector of the user. No LLM involved,
+    so it works offline and always returns the same ranking for the same inputs.
+
+    The profile blends the embeddings of the clicked titles, weighted by an exponential time decay, with the
+    embedding of the preferences text.
+
+    Args:
+        news_vector_storage (NewsVectorStorage): shared vector storage, used for embeddings
+        n_recommendations (int, optional): number of articles to recommend. Defaults to 10.
+        half_life_days (float, optional): a click this many days old weighs half as much as one from now. Defaults to 2.
+        preferences_weight (float, optional): share of the preferences in the profile when there are clicks too. Defaults to 0.5.
+    """
+    def __init__(self, news_vector_storage, n_recommendations=10, half_life_days=2.0, preferences_weight=0.5) -> None:
+        self._news_vector_storage = news_vector_storage
+        self._n_recommendations = n_recommendations
+        self._half_life_days = half_life_days
+        self._preferences_weight = preferences_weight
+
+    @staticmethod
+    def _normalize(vectors: np.ndarray) -> np.ndarray:
+        norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+        return vectors / np.where(norms == 0, 1, norms)
+
+    def _profiles(self, history: pd.DataFrame, preferences: str):
+        """Returns (clicks_profile, preferences_profile), each a unit vector or None when there is no signal"""
+        clicks_profile = None
+        if len(history):
+            clicked_at = np.array([date.to_pydatetime().timestamp() for date in history['date']])
+            ages_days = (time.time() - clicked_at) / (24 * 60 * 60)
+            weights = np.exp2(-np.maximum(ages_days, 0) / self._half_life_days)
+            embeddings = self._normalize(self._news_vector_storage.embed(history['title'].tolist()))
+            clicks_profile = self._normalize(weights @ embeddings)
+        preferences_profile = None
+        if preferences.strip() and preferences != "None":
+            preferences_profile = self._normalize(self._news_vector_storage.embed([preferences])[0])
+        return clicks_profile, preferences_profile
+
+    def score(self, user_id: str, candidates: Candidates, template_constructor) -> dict:
+        """Blocking part of rank, scores all candidates at once with a single matrix product"""
+        ranking_inputs = template_constructor.get_ranking_inputs(user_id)
+        clicks_profile, preferences_profile = self._profiles(ranking_inputs["history"], ranking_inputs["preferences"])
+        titles = candidates.title
+        candidate_embeddings = self._news_vector_storage.get_embeddings(candidates.link)
+        if (clicks_profile is None and preferences_profile is None) or candidate_embeddings.shape[1] == 0:
+            # nothing to personalize on, keep the retrieval order
+            picked = list(range(1, min(len(titles), self._n_recommendations) + 1))
+            return {"ids": picked, "explanations": [NO_SIGNAL_EXPLANATION] * len(picked)}
+
+        candidate_embeddings = self._normalize(candidate_embeddings)
+        clicks_scores = candidate_embeddings @ clicks_profile if clicks_profile is not None else None
+        preferences_scores = candidate_embeddings @ preferences_profile if preferences_profile is not None else None
+        if clicks_scores is None:
+            scores = preferences_scores
+        elif preferences_scores is None:
+            scores = clicks_scores
+        else:
+            scores = self._preferences_weight * preferences_scores + (1 - self._preferences_weight) * clicks_scores
+
+        # stable sort keeps the retrieval order between equal scores, so the ranking is deterministic
+        top = np.argsort(-scores, kind='stable')[:self._n_recommendations]
+        explanations = []
+        for index in top:
+            if preferences_scores is not None and (clicks_scores is None or preferences_scores[index] >= clicks_scores[index]):
+                explanations.append("Matches the preferences you told us about.")
+            else:
+                explanations.append("Similar to articles you have read recently.")
+        return {"ids": [int(index) + 1 for index in top], "explanations": explanations}
+
+    async def rank(self, user_id: str, candidates: Candidates, template_constructor) -> dict:
+        return await asyncio.to_thread(self.score, user_id, candidates, template_constructor)
+
+
+class HybridRanker(EmbeddingRanker):
+    """Ranks locally like EmbeddingRanker, then asks GPT only to explain the picked articles.
+    The prompt holds 10 titles instead of every candidate and the ranking does not depend on GPT's answer at all.
+
+    Args:
+        news_vector_storage (NewsVectorStorage): shared vector storage, used for embeddings
+        llm_client (LLMClient): shared async GPT client
+        **kwargs: see EmbeddingRanker
+    """
+    def __init__(self, news_vector_storage, llm_client, **kwargs) -> None:
+        super().__init__(news_vector_storage, **kwargs)
+        self._llm_client = llm_client
+
+    async def rank(self, user_id: str, candidates: Candidates, template_constructor) -> dict:
+        ranked = await super().rank(user_id, candidates, template_constructor)
+        titles = [candidates.title[id - 1] for id in ranked["ids"]]
+        prompt = await asyncio.to_thread(template_constructor.construct_explanations_prompt, user_id, titles)
+        try:
+            explanations = (await self._llm_client.complete_json(prompt)).get("explanations", [])
+        except Exception as e:
+            logger.warning(f"Explanations from GPT failed, keeping the local ones: {e!r}")
+            return ranked
+        # keep the local explanation wherever GPT returned fewer than asked
+        ranked["explanations"] = [str(explanation) for explanation in explanations[:len(ranked["ids"])]] + \
+            ranked["explanations"][len(explanations):]
+        return ranked
+
+    async def rank_stream(self, user_id: str, candidates: Candidates, template_constructor):
+        ranked = await super().rank(user_id, candidates, template_constructor)
+        titles = [candidates.title[id - 1] for id in ranked["ids"]]
+        prompt = await asyncio.to_thread(template_constructor.construct_explanations_prompt, user_id, titles)
+        # the ranking is known upfront, every explanation completes the next article
+        streamed = 0
+        try:
+            async for key, explanation in _stream_arrays(self._llm_client, prompt):
+                if key == "explanations" and streamed < len(ranked["ids"]):
+                    yield ranked["ids"][streamed], str(explanation)
+                    streamed += 1
+        except Exception as e:
+            logger.warning(f"Explanations from GPT failed, keeping the local ones: {e!r}")
+        for id, explanation in zip(ranked["ids"][streamed:], ranked["explanations"][streamed:]):
+            yield id, explanation
+
+
+def make_ranker(mode: str, news_vector_storage, llm_client) -> Ranker:
+    """Builds the ranker for a ranking mode: "gpt", "local" or "hybrid" """
+    if mode == "gpt":
+        return GPTRanker(llm_client)
+    if mode == "local":
+        return EmbeddingRanker(news_vector_storage)
+    if mode == "hybrid":
+        return HybridRanker(news_vector_storage, llm_client)
+    raise ValueError(f"Unknown ranking mode: {mode}")
@@ -0,0 +1,261 @@
+import asyncio
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from app_requests.Metrics import METRICS
+
+logger = logging.getLogger(__name__)
+
+
+class RecommendationStore:
+    """Keeps the last recommendation payload of every user and serves it stale-while-revalidate.
+
+    Every payload is stored with the fingerprint of the inputs it was computed from (click history,
+    preferences and news version). A request gets the stored payload immediately; when its fingerprint no
+    longer matches, or it is older than max_age, a background refresh is scheduled. Clicks, preference
+    adjustments and ingests schedule refreshes as well. Refreshes are single-flight per user and skip the
+    LLM when the fingerprint did not change, so the pipeline runs at most once per meaningful change.
+    Memory stays bounded: users inactive for longer than active_window are dropped on every ingest, and at most
+    max_entries payloads are kept, least recently used first out. Dropped payloads are reloaded from disk on demand.
+
+    Args:
+        compute (callable): coroutine function user_id -> payload, the full recommendation pipeline
+        fingerprint (callable): blocking function user_id -> fingerprint of the pipeline inputs
+        max_age (float, optional): seconds after which a payload is refreshed even if its inputs did not change. Defaults to 6 hours.
+        active_window (float, optional): users who asked for recommendations within this many seconds are refreshed after an ingest. Defaults to 24 hours.
+        disk_path (str, optional): SQLite file keeping the payloads across restarts. None keeps them in memory only.
+        max_entries (int, optional): payloads kept in memory at most. Defaults to 10_000.
+    """
+    def __init__(self, compute, fingerprint, max_age=6 * 60 * 60, active_window=24 * 60 * 60, disk_path=None,
+                 max_entries=10_000) -> None:
+        self._compute = compute
+        self._fingerprint = fingerprint
+        self._max_age = max_age
+        self._active_window = active_window
+        self._max_entries = max_entries
+        # least recently used first
+        self._entries = OrderedDict()
+        self._last_access = {}
+        self._refreshes = {}
+        self._pending_refreshes = set()
+        self._loop = None
+        self._disk = None
+        self._disk_lock = threading.Lock()
+        if disk_path is not None:
+            self._disk = sqlite3.connect(disk_path, check_same_thread=False)
+            self._disk.execute("CREATE TABLE IF NOT EXISTS recommendations (user_id TEXT PRIMARY KEY, fingerprint TEXT NOT NULL, payload TEXT NOT NULL, computed REAL NOT NULL)")
+            self._disk.commit()
+
+    def _load_from_disk(self, user_id: str):
+        with self._disk_lock:
+            row = self._disk.execute("SELECT fingerprint, payload, computed FROM recommendations WHERE user_id = ?", (user_id,)).fetchone()
+        if row is None:
+            return None
+        fingerprint, payload, computed = row
+        return {"fingerprint": fingerprint, "payload": json.loads(payload), "computed": computed}
+
+    def _save_to_disk(self, user_id: str, entry: dict) -> None:
+        with self._disk_lock:
+            self._disk.execute("INSERT OR REPLACE INTO recommendations VALUES (?, ?, ?, ?)",
+                               (user_id, entry["fingerprint"], json.dumps(entry["payload"]), entry["computed"]))
+            self._disk.commit()
+
+    def _is_fresh(self, entry: dict, fingerprint: str) -> bool:
+        return entry["fingerprint"] == fingerprint and time.time() - entry["computed"] <= self._max_age
+
+    def _remember(self, user_id: str, entry: dict) -> dict:
+        """Keeps the entry in memory as the most recently used one, dropping the least recently used beyond max_entries"""
+        self._entries[user_id] = entry
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self._max_entries:
+            evicted, _ = self._entries.popitem(last=False)
+            self._last_access.pop(evicted, None)
+        return entry
+
+    def _touch(self, user_id: str) -> None:
+        self._last_access[user_id] = time.time()
+        if user_id in self._entries:
+            self._entries.move_to_end(user_id)
+
+    def _evict_inactive(self) -> None:
+        """Drops the users neither served nor computed within active_window, their payloads stay on disk"""
+        inactive_since = time.time() - self._active_window
+        for user_id in [user_id for user_id, accessed in self._last_access.items() if accessed < inactive_since]:
+            del self._last_access[user_id]
+        for user_id in [user_id for user_id, entry in self._entries.items()
+                        if user_id not in self._last_access and user_id not in self._refreshes and entry["computed"] < inactive_since]:
+            del self._entries[user_id]
+
+    async def _get_entry(self, user_id: str):
+        entry = self._entries.get(user_id)
+        if entry is None and self._disk is not None:
+            entry = await asyncio.to_thread(self._load_from_disk, user_id)
+            if entry is not None:
+                # another request may have loaded or computed it meanwhile
+                entry = self._remember(user_id, self._entries.get(user_id, entry))
+        return entry
+
+    async def get(self, user_id: str) -> dict:
+        """Returns the user's recommendations, computing them only when the user has none stored yet"""
+        self._loop = asyncio.get_running_loop()
+        self._touch(user_id)
+        entry = await self._get_entry(user_id)
+        if entry is None:
+            return await self._refresh_single_flight(user_id)
+
+        fingerprint = await self.fingerprint(user_id)
+        if not self._is_fresh(entry, fingerprint):
+            self.schedule_refresh(user_id)
+        return entry["payload"]
+
+    async def refresh(self, user_id: str, compute=None, force=False) -> dict:
+        """Brings the user's recommendations up to date now and returns them, e.g. for batch refreshes.
+        Joins a refresh of the user already in flight instead of computing twice.
+
+        Args:
+            user_id (str): The ID of the user.
+            compute (callable, optional): coroutine function user_id -> payload used instead of the store's own pipeline.
+            force (bool, optional): recomputes even when the stored payload is still fresh. Defaults to False.
+        """
+        self._loop = asyncio.get_running_loop()
+        await self._get_entry(user_id)
+        return await self._refresh_single_flight(user_id, compute, force)
+
+    async def get_fresh(self, user_id: str):
+        """Returns the user's stored recommendations when their inputs did not change since, None otherwise. Never computes."""
+        self._loop = asyncio.get_running_loop()
+        self._touch(user_id)
+        entry = await self._get_entry(user_id)
+        if entry is None:
+            return None
+        fingerprint = await self.fingerprint(user_id)
+        return entry["payload"] if self._is_fresh(entry, fingerprint) else None
+
+    async def stream(self, user_id: str, compute_stream):
+        """Yields the user's recommendations article by article, as dicts with the keys of the payload.
+
+        Fresh stored recommendations are replayed. A refresh of the user already in flight is joined and its result
+        replayed. Otherwise the streamed computation becomes the user's in-flight refresh: articles are yielded as
+        compute_stream produces them, concurrent requests for the user join it instead of computing again, and the
+        result is stored once complete. It runs to completion even if the consumer goes away, as others may wait on it.
+
+        Args:
+            user_id (str): The ID of the user.
+            compute_stream (callable): async generator function user_id -> articles, the streamed pipeline
+        """
+        self._loop = asyncio.get_running_loop()
+        self._touch(user_id)
+        entry = await self._get_entry(user_id)
+        if entry is not None and user_id not in self._refreshes:
+            fingerprint = await self.fingerprint(user_id)
+            if self._is_fresh(entry, fingerprint):
+                for article in self._articles(entry["payload"]):
+                    yield article
+                return
+
+        task = self._refreshes.get(user_id)
+        if task is not None:
+            for article in self._articles(await asyncio.shield(task)):
+                yield article
+            return
+
+        articles = asyncio.Queue()
+        task = self._refresh_single_flight(user_id, compute=lambda user_id: self._collect_stream(user_id, compute_stream, articles),
+                                           force=True)
+        # wakes the consumer up however the refresh ends, failures included
+        task.add_done_callback(lambda finished: articles.put_nowait(None))
+        while (article := await articles.get()) is not None:
+            yield article
+        task.result()
+
+    @staticmethod
+    async def _collect_stream(user_id: str, compute_stream, articles: asyncio.Queue) -> dict:
+        collected = []
+        async for article in compute_stream(user_id):
+            collected.append(article)
+            articles.put_nowait(article)
+        # same column-wise shape as the computed payloads
+        columns = dict.fromkeys(column for article in collected for column in article)
+        return {column: [article.get(column) for article in collected] for column in columns}
+
+    @staticmethod
+    def _articles(payload: dict):
+        for values in zip(*payload.values()):
+            yield dict(zip(payload, values))
+
+    async def fingerprint(self, user_id: str) -> str:
+        return await asyncio.to_thread(self._fingerprint, user_id)
+
+    async def put(self, user_id: str, fingerprint: str, payload: dict) -> None:
+        """Stores recommendations computed outside of the store, e.g. streamed ones.
+
+        Args:
+            user_id (str): The ID of the user.
+            fingerprint (str): fingerprint of the inputs, taken before computing the payload (see fingerprint)
+            payload (dict): the recommendations, shaped like the compute results
+        """
+        entry = self._remember(user_id, {"fingerprint": fingerprint, "payload": payload, "computed": time.time()})
+        if self._disk is not None:
+            await asyncio.to_thread(self._save_to_disk, user_id, entry)
+
+    async def _refresh(self, user_id: str, compute=None, force=False) -> dict:
+        fingerprint = await self.fingerprint(user_id)
+        entry = self._entries.get(user_id)
+        if not force and entry is not None and self._is_fresh(entry, fingerprint):
+            return entry["payload"]
+        with METRICS.span('recommendation_compute'):
+            payload = await (compute or self._compute)(user_id)
+        await self.put(user_id, fingerprint, payload)
+        return payload
+
+    def _refresh_single_flight(self, user_id: str, compute=None, force=False) -> asyncio.Task:
+        task = self._refreshes.get(user_id)
+        if task is None:
+            task = asyncio.ensure_future(self._refresh(user_id, compute, force))
+            self._refreshes[user_id] = task
+            task.add_done_callback(lambda finished: self._on_refresh_done(user_id, finished))
+        return task
+
+    def _on_refresh_done(self, user_id: str, task: asyncio.Task) -> None:
+        self._refreshes.pop(user_id, None)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"Refreshing recommendations of user {user_id} failed: {task.exception()!r}")
+        # an event arrived while computing, the inputs may have changed again
+        if user_id in self._pending_refreshes:
+            self._pending_refreshes.discard(user_id)
+            self._refresh_single_flight(user_id)
+
+    def schedule_refresh(self, user_id: str) -> None:
+        """Recomputes the user's recommendations in the background, must be called from the event loop"""
+        self._loop = asyncio.get_running_loop()
+        if user_id not in self._entries and user_id not in self._last_access:
+            # nothing served to this user yet, the first request computes anyway
+            return
+        if user_id in self._refreshes:
+            self._pending_refreshes.add(user_id)
+            return
+        self._refresh_single_flight(user_id)
+
+    def refresh_active_threadsafe(self) -> None:
+        """Schedules a refresh for every recently active user, callable from any thread (e.g. after an ingest)"""
+        if self._loop is None:
+            return
+        self._loop.call_soon_threadsafe(self._refresh_active)
+
+    def _refresh_active(self) -> None:
+        self._evict_inactive()
+        for user_id in list(self._last_access):
+            self.schedule_refresh(user_id)
+
+    async def close(self) -> None:
+        self._pending_refreshes.clear()
+        refreshes = list(self._refreshes.values())
+        for task in refreshes:
+            task.cancel()
+        await asyncio.gather(*refreshes, return_exceptions=True)
+        if self._disk is not None:
+            self._disk.close()
@@ -1,52 +1,123 @@
 import pandas as pd
-from datetime import datetime, timedelta
+from LLM_interactions.TokenBudget import TokenBudget
+from app_requests.InteractionStore import InteractionStore
+from vector_database.Candidates import Candidates
+import logging
+
+logger = logging.getLogger(__name__)
+
+TEMPLATE_PATHS = {
+    'topics': 'LLM_interactions/templates/template_topics.txt',
+    'recommendations': 'LLM_interactions/templates/template_recommendation.txt',
+    'recommendation_adjustment': 'LLM_interactions/templates/template_recommendation_adjustment.txt',
+    'explanations': 'LLM_interactions/templates/template_explanations.txt',
+}
 
 
 class RecommendationTemplateConstructor:
-    def __init__(self, last_days_interaction = 7) -> None:
-        self._user_interaction_history = None
-        self._user_preferences = None
+    """Builds GPT prompts from the templates and the user's data.
+    Holds no per-user state, the templates are only read, never formatted in place.
+
+    Prompts are kept within the token budget: titles are listed one per line instead of as Python lists, candidates
+    are numbered so GPT answers with short IDs instead of echoing titles, and the interaction history gets whatever
+    the budget leaves, most recent clicks first, each title once.
+
+    Args:
+        last_days_interaction (int, optional): window of the interaction history put into the prompts. Defaults to 7.
+        templates (dict, optional): already loaded templates as returned by read_templates. Read from disk when None.
+        interaction_store (InteractionStore, optional): shared store of the user clicks. Opened with defaults when None.
+        token_budget (TokenBudget, optional): shared token counter and prompt size metrics. A default one is created when None.
+    """
+    def __init__(self, last_days_interaction = 7, templates=None, interaction_store=None, token_budget=None) -> None:
         self._last_days_interaction = last_days_interaction
-        self.template_topics = self.read_template('LLM_interactions/templates/template_topics.txt')
-        self.template_recommendations = self.read_template('LLM_interactions/templates/template_recommendation.txt')
-        self.template_recommendation_adjustment = self.read_template('LLM_interactions/templates/template_recommendation_adjustment.txt')
-    
-    def read_template(self, template_path: str) -> str:
+        self._interaction_store = interaction_store if interaction_store is not None else InteractionStore()
+        self._token_budget = token_budget if token_budget is not None else TokenBudget()
+        if templates is None:
+            templates = self.read_templates()
+        self.template_topics = templates['topics']
+        self.template_recommendations = templates['recommendations']
+        self.template_recommendation_adjustment = templates['recommendation_adjustment']
+        self.template_explanations = templates['explanations']
+
+    @staticmethod
+    def read_template(template_path: str) -> str:
         with open(template_path, 'r') as file:
             return file.read()
-    
-    def _get_interaction_history(self, user_id: str) -> None:
-        try:
-            self._user_interaction_history = pd.read_csv(f'LLM_interactions/UserInteractionHistory/{user_id}_interactions_history.csv', parse_dates=['date'], dayfirst=True)
-            # Filter interactions from the last 7 days
-            self._user_interaction_history = self._user_interaction_history[self._user_interaction_history['date'] >= (datetime.now() - timedelta(days=self._last_days_interaction))]
-        except FileNotFoundError:
-            self._user_interaction_history = pd.DataFrame(columns=["title", "date", "domain"])
-    
-    def _get_user_preferences(self, user_id: str) -> None:
+
+    @classmethod
+    def read_templates(cls) -> dict:
+        return {name: cls.read_template(path) for name, path in TEMPLATE_PATHS.items()}
+
+    def _get_interaction_history(self, user_id: str) -> pd.DataFrame:
+        # indexed range read of the last days only
+        return self._interaction_store.get_window(user_id, self._last_days_interaction)
+
+    def _get_user_preferences(self, user_id: str) -> str:
         try:
             with open(f'LLM_interactions/UserPreferences/{user_id}.txt', 'r') as file:
-                self._user_preferences = file.read()
+                preferences = file.read()
         except FileNotFoundError:
-            self._user_preferences = "None"
-    
-    def construct_getting_topics_prompt(self, user_id: str) -> str:
-        self._get_interaction_history(user_id)
-        self._get_user_preferences(user_id)
-        self.template_topics = self.template_topics.format(days=self._last_days_interaction, articles=self._user_interaction_history['title'].tolist(), preferences=self._user_preferences)
-        return self.template_topics
-    
-    def construct_recommendation_prompt(self, user_id: str, candidates:pd.DataFrame) -> str:
-        self._get_interaction_history(user_id)
-        self._get_user_preferences(user_id)
-        candidate_titles = candidates['title'].tolist()
-        self.template_recommendations = self.template_recommendations.format(days=self._last_days_interaction,
-                                                                             articles=self._user_interaction_history['title'].tolist(),
-                                                                             preferences=self._user_preferences, candidates=candidate_titles)
-        return self.template_recommendations
-    
+            return "None"
+        # new users get an empty file, which must read the same as no file, or their inputs change after the first request
+        return preferences if preferences.strip() else "None"
+
+    def get_topics_prompt_inputs(self, user_id: str) -> dict:
+        """Everything the topics prompt depends on, also used to fingerprint it for caching"""
+        return {"articles": self._get_interaction_history(user_id)['title'].tolist(),
+                "preferences": self._get_user_preferences(user_id)}
+
+    @staticmethod
+    def number_candidates(titles: list) -> list:
+        """Candidate lines of the prompts, "<ID>. <title>" where the ID is the 1-based position of the candidate"""
+        return [f"{id}. {title}" for id, title in enumerate(titles, start=1)]
+
+    def _compact_history(self, titles: list, budget: int) -> str:
+        # most recent first, so truncating to the budget drops the oldest clicks
+        recent_first = list(dict.fromkeys(reversed(titles)))
+        lines = self._token_budget.fit([f"- {title}" for title in recent_first], budget)
+        return "\n".join(lines) if lines else "None"
+
+    def _build_prompt(self, kind: str, template: str, history_titles: list, **fields) -> str:
+        """Formats template, the interaction history gets the budget left after all the other fields"""
+        budget = self._token_budget.max_prompt_tokens - self._token_budget.count(template.format(articles="", **fields))
+        prompt = template.format(articles=self._compact_history(history_titles, budget), **fields)
+        self._token_budget.record(kind, self._token_budget.count(prompt))
+        return prompt
+
+    def construct_getting_topics_prompt(self, user_id: str, prompt_inputs=None) -> str:
+        if prompt_inputs is None:
+            prompt_inputs = self.get_topics_prompt_inputs(user_id)
+        return self._build_prompt("topics", self.template_topics, prompt_inputs["articles"],
+                                  days=self._last_days_interaction, preferences=prompt_inputs["preferences"])
+
+    def construct_recommendation_prompt(self, user_id: str, candidates: Candidates) -> str:
+        """Lists the candidates by ID, see number_candidates. Candidates past the budget are left out from the end."""
+        user_interaction_history = self._get_interaction_history(user_id)
+        user_preferences = self._get_user_preferences(user_id)
+        fixed_part = self.template_recommendations.format(days=self._last_days_interaction, articles="",
+                                                          preferences=user_preferences, candidates="")
+        candidate_lines = self._token_budget.fit(self.number_candidates(candidates.title),
+                                                 self._token_budget.max_prompt_tokens - self._token_budget.count(fixed_part))
+        if len(candidate_lines) < len(candidates):
+            logger.warning(f"Only {len(candidate_lines)} of {len(candidates)} candidates fit into the prompt token budget")
+        return self._build_prompt("recommendations", self.template_recommendations, user_interaction_history['title'].tolist(),
+                                  days=self._last_days_interaction, preferences=user_preferences,
+                                  candidates="\n".join(candidate_lines))
+
+    def get_ranking_inputs(self, user_id: str) -> dict:
+        """Windowed click history (with dates) and preferences, for rankers that do not go through a prompt"""
+        return {"history": self._get_interaction_history(user_id),
+                "preferences": self._get_user_preferences(user_id)}
+
+    def construct_explanations_prompt(self, user_id: str, titles: list) -> str:
+        user_interaction_history = self._get_interaction_history(user_id)
+        user_preferences = self._get_user_preferences(user_id)
+        return self._build_prompt("explanations", self.template_explanations, user_interaction_history['title'].tolist(),
+                                  days=self._last_days_interaction, preferences=user_preferences,
+                                  candidates="\n".join(self.number_candidates(titles)))
+
     def construct_recommendation_adjustment_prompt(self, user_id: str, request:str) -> str:
-        self._get_user_preferences(user_id)
-        self.template_recommendation_adjustment = self.template_recommendation_adjustment.format(preferences=self._user_preferences, request=request)
-        return self.template_recommendation_adjustment
-    
\ No newline at end of file
+        user_preferences = self._get_user_preferences(user_id)
+        prompt = self.template_recommendation_adjustment.format(preferences=user_preferences, request=request)
+        self._token_budget.record("recommendation_adjustment", self._token_budget.count(prompt))
+        return prompt
@@ -0,0 +1,69 @@
+import logging
+import math
+import threading
+
+from app_requests.Metrics import METRICS
+
+try:
+    import tiktoken
+except ImportError:
+    # optional, without it token counts are estimated
+    tiktoken = None
+
+logger = logging.getLogger(__name__)
+
+METRICS.describe('prompt_tokens', 'Tokens of the built prompts, counted locally', buckets=(128, 256, 512, 1024, 2048, 4096, 8192))
+
+
+class TokenBudget:
+    """Counts prompt tokens, fits prompt lines into a token budget and records the size of every built prompt.
+
+    Counts exactly with tiktoken when it is installed, otherwise estimates 4 characters per token, the usual
+    rule of thumb for English text.
+
+    Args:
+        max_prompt_tokens (int, optional): budget of one whole prompt. Defaults to 2000.
+        encoding_name (str, optional): tiktoken encoding, used when tiktoken is installed. Defaults to "cl100k_base".
+    """
+    def __init__(self, max_prompt_tokens=2000, encoding_name="cl100k_base") -> None:
+        self.max_prompt_tokens = max_prompt_tokens
+        self._encoding = None
+        if tiktoken is not None:
+            try:
+                self._encoding = tiktoken.get_encoding(encoding_name)
+            except Exception as e:
+                logger.warning(f"Could not load the {encoding_name} encoding, estimating token counts: {e!r}")
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def count(self, text: str) -> int:
+        if self._encoding is not None:
+            return len(self._encoding.encode(text, disallowed_special=()))
+        return math.ceil(len(text) / 4)
+
+    def fit(self, lines: list, budget: int) -> list:
+        """Returns the longest prefix of lines that fits into budget tokens once joined by newlines"""
+        fitted, used = [], 0
+        for line in lines:
+            used += self.count(line) + 1
+            if used > budget:
+                break
+            fitted.append(line)
+        return fitted
+
+    def record(self, kind: str, tokens: int) -> None:
+        """Records the size of one built prompt of the given kind (topics, recommendations, ...)"""
+        with self._lock:
+            stats = self._stats.setdefault(kind, {"prompts": 0, "tokens_total": 0, "tokens_max": 0, "tokens_last": 0})
+            stats["prompts"] += 1
+            stats["tokens_total"] += tokens
+            stats["tokens_max"] = max(stats["tokens_max"], tokens)
+            stats["tokens_last"] = tokens
+        METRICS.observe('prompt_tokens', tokens, kind=kind)
+        logger.info(f"Built {kind} prompt of {tokens} tokens")
+
+    def stats(self) -> dict:
+        """Tokens per prompt recorded so far, per prompt kind"""
+        with self._lock:
+            return {kind: dict(stats, tokens_mean=stats["tokens_total"] / stats["prompts"])
+                    for kind, stats in self._stats.items()}
@@ -0,0 +1,97 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+class TopicCache:
+    """Cache of the topics GPT derived for a user, keyed by a fingerprint of the prompt inputs
+    (windowed click history and preferences), so a repeat visit with unchanged inputs skips the LLM call.
+
+    Entries are evicted least recently used first and expire after ttl_seconds. An optional SQLite file
+    keeps them across restarts and shares them between workers.
+
+    Args:
+        max_entries (int, optional): capacity of the in-memory tier. Defaults to 1024.
+        ttl_seconds (float, optional): lifetime of an entry. Defaults to 6 hours.
+        disk_path (str, optional): SQLite file of the on-disk tier. None keeps the cache in memory only.
+    """
+    def __init__(self, max_entries=1024, ttl_seconds=6 * 60 * 60, disk_path=None) -> None:
+        self._max_entries = max_entries
+        self._ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()
+        self._user_fingerprints = {}
+        self._lock = threading.Lock()
+        self._disk = None
+        if disk_path is not None:
+            # shared by every worker, WAL lets them read while one writes
+            self._disk = sqlite3.connect(disk_path, timeout=30, check_same_thread=False)
+            self._disk.execute("PRAGMA journal_mode=WAL")
+            self._disk.execute("PRAGMA synchronous=NORMAL")
+            self._disk.execute("CREATE TABLE IF NOT EXISTS topics (fingerprint TEXT PRIMARY KEY, topics TEXT NOT NULL, created REAL NOT NULL)")
+            self._disk.commit()
+
+    @staticmethod
+    def fingerprint(articles: list, preferences: str) -> str:
+        return hashlib.sha256(json.dumps([articles, preferences]).encode('utf-8')).hexdigest()
+
+    def _get_from_disk(self, fingerprint: str):
+        row = self._disk.execute("SELECT topics, created FROM topics WHERE fingerprint = ?", (fingerprint,)).fetchone()
+        if row is None:
+            return None
+        topics, created = row
+        if time.time() - created > self._ttl_seconds:
+            self._disk.execute("DELETE FROM topics WHERE fingerprint = ?", (fingerprint,))
+            self._disk.commit()
+            return None
+        return json.loads(topics), created
+
+    def get(self, user_id: str, fingerprint: str):
+        """Returns the cached topics for these inputs, or None on a miss"""
+        with self._lock:
+            entry = self._entries.get(fingerprint)
+            if entry is None and self._disk is not None:
+                entry = self._get_from_disk(fingerprint)
+                if entry is not None:
+                    self._store(fingerprint, entry)
+            if entry is None:
+                return None
+            topics, created = entry
+            if time.time() - created > self._ttl_seconds:
+                del self._entries[fingerprint]
+                return None
+            self._entries.move_to_end(fingerprint)
+            self._user_fingerprints[user_id] = fingerprint
+            return topics
+
+    def _store(self, fingerprint: str, entry: tuple) -> None:
+        self._entries[fingerprint] = entry
+        self._entries.move_to_end(fingerprint)
+        while len(self._entries) > self._max_entries:
+            self._entries.popitem(last=False)
+
+    def put(self, user_id: str, fingerprint: str, topics: dict) -> None:
+        created = time.time()
+        with self._lock:
+            self._store(fingerprint, (topics, created))
+            self._user_fingerprints[user_id] = fingerprint
+            if self._disk is not None:
+                self._disk.execute("INSERT OR REPLACE INTO topics VALUES (?, ?, ?)", (fingerprint, json.dumps(topics), created))
+                self._disk.commit()
+
+    def invalidate(self, user_id: str) -> None:
+        """Drops the entry last used by the user, called when their clicks or preferences change"""
+        with self._lock:
+            fingerprint = self._user_fingerprints.pop(user_id, None)
+            if fingerprint is None:
+                return
+            self._entries.pop(fingerprint, None)
+            if self._disk is not None:
+                self._disk.execute("DELETE FROM topics WHERE fingerprint = ?", (fingerprint,))
+                self._disk.commit()
+
+    def close(self) -> None:
+        if self._disk is not None:
+            self._disk.close()
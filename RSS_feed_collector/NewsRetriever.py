@@ -1,37 +1,147 @@
-import pandas as pd
-import feedparser
+import json
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from urllib.parse import urlparse
 
+import feedparser
+import pandas as pd
+import urllib3
+
+from app_requests.Metrics import METRICS
+
+logger = logging.getLogger(__name__)
+
+NEWS_COLUMNS = ['title', 'link', 'domain', 'published', 'summary']
+
+
 class NewsRetriever:
     """Manages retrieval of news from RSS feeds to than be stored in a vector database
+
+    Feeds are fetched concurrently on a bounded thread pool with a per-host limit. ETag/Last-Modified
+    validators are remembered between runs so that unchanged feeds answer 304 and are skipped.
+
+    Args:
+        rss_feeds (list): list of RSS feed URLs
+        max_workers (int, optional): size of the fetching thread pool. Defaults to 8.
+        max_per_host (int, optional): maximum simultaneous requests to one host. Defaults to 2.
+        timeout (float, optional): per-feed timeout in seconds. Defaults to 10.
+        feed_state_path (str, optional): JSON file with the conditional GET validators of every feed.
+            None disables conditional requests.
     """
-    def __init__(self, rss_feeds:list) -> None:
+    def __init__(self, rss_feeds: list, max_workers=8, max_per_host=2, timeout=10.0,
+                 feed_state_path='RSS_feed_collector/feed_state.json') -> None:
         self.rss_feeds = rss_feeds
         self._news_df = None
-        
-    def _prepare_dataframe(self):
-        self._news_df = pd.DataFrame(columns=['title', 'link', 'domain', 'published', 'summary'])
-            
-    # def _save_news(self):
-    #     # ensure the old file is overwritten
-    #     self._news_df.drop_duplicates(inplace=True, subset=['link'])
-    #     self._news_df.to_csv(self.csv_database_name, index=False)
-            
-        
+        self._max_workers = max_workers
+        self._max_per_host = max_per_host
+        self._timeout = timeout
+        self._feed_state_path = feed_state_path
+        self._feed_state = self._read_feed_state()
+        self._host_limits = {}
+        self._host_limits_lock = threading.Lock()
+        self._http = urllib3.PoolManager(maxsize=max_per_host, retries=False)
+        self.feed_statuses = {}
+
+    def _read_feed_state(self) -> dict:
+        if self._feed_state_path is None:
+            return {}
+        try:
+            with open(self._feed_state_path, 'r') as file:
+                return json.load(file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def save_feed_state(self) -> None:
+        """Persists the validators of the last retrieval.
+        Call it only after the retrieved news were stored, otherwise the next run would skip them as unchanged.
+        """
+        if self._feed_state_path is None:
+            return
+        tmp_path = self._feed_state_path + '.tmp'
+        with open(tmp_path, 'w') as file:
+            json.dump(self._feed_state, file)
+        os.replace(tmp_path, self._feed_state_path)
+
+    def _host_limit(self, host: str) -> threading.BoundedSemaphore:
+        with self._host_limits_lock:
+            if host not in self._host_limits:
+                self._host_limits[host] = threading.BoundedSemaphore(self._max_per_host)
+            return self._host_limits[host]
+
+    def _conditional_headers(self, rss_feed: str) -> dict:
+        headers = {}
+        validators = self._feed_state.get(rss_feed, {})
+        if validators.get('etag'):
+            headers['If-None-Match'] = validators['etag']
+        if validators.get('last_modified'):
+            headers['If-Modified-Since'] = validators['last_modified']
+        return headers
+
+    @staticmethod
+    def _entries_to_rows(entries) -> list:
+        rows = []
+        for entry in entries:
+            if not all(key in entry for key in ('title', 'link', 'published')):
+                continue
+            rows.append({'title': entry.title,
+                         'link': entry.link,
+                         # get the domain name from the url
+                         'domain': urlparse(entry.link).netloc,
+                         'published': entry.published,
+                         'summary': entry.get('summary', '')})
+        return rows
+
+    def _fetch_feed(self, rss_feed: str):
+        """Fetches and parses a single feed.
+
+        Returns:
+            tuple: (status, rows, validators) where status is either "ok" or "not_modified"
+        """
+        with METRICS.span('rss_fetch', feed=rss_feed):
+            with self._host_limit(urlparse(rss_feed).netloc):
+                logger.info(f'Retrieving news from {rss_feed}...')
+                response = self._http.request('GET', rss_feed, headers=self._conditional_headers(rss_feed),
+                                              timeout=urllib3.Timeout(total=self._timeout), preload_content=True)
+            if response.status == 304:
+                return 'not_modified', [], None
+            if response.status != 200:
+                raise ValueError(f'HTTP status {response.status}')
+
+            feed = feedparser.parse(response.data)
+            if feed.bozo and not feed.entries:
+                raise ValueError(f'malformed feed: {feed.get("bozo_exception")}')
+            validators = {'etag': response.headers.get('ETag'),
+                          'last_modified': response.headers.get('Last-Modified')}
+            return 'ok', self._entries_to_rows(feed.entries), validators
+
     def retrieve_news(self):
-        self._prepare_dataframe()
-        for rss_feed in self.rss_feeds:
-            print(f'Retrieving news from {rss_feed}...')
-            feed = feedparser.parse(rss_feed)
-            if feed.bozo == 0:
-                for entry in feed.entries:
-                    # get the domain name from the url
-                    domain = urlparse(entry.link).netloc
-                    self._news_df = pd.concat([self._news_df, pd.DataFrame({'title': [entry.title],
-                                                                            'link': [entry.link],
-                                                                            'domain': [domain],
-                                                                            'published': [entry.published],
-                                                                            'summary': [entry.summary]}, index=[0])], ignore_index=True)
-            else:
-                print(f'Error parsing feed {rss_feed}') # implement logging for the whole application later
-        return self._news_df
\ No newline at end of file
+        rows_by_feed = {}
+        self.feed_statuses = {}
+        with ThreadPoolExecutor(max_workers=self._max_workers) as executor:
+            futures = {executor.submit(self._fetch_feed, rss_feed): rss_feed for rss_feed in self.rss_feeds}
+            for future in as_completed(futures):
+                rss_feed = futures[future]
+                try:
+                    status, feed_rows, validators = future.result()
+                except Exception as e:
+                    # a broken feed must not take the others down with it
+                    logger.warning(f'Error retrieving feed {rss_feed}: {e}')
+                    self.feed_statuses[rss_feed] = 'error'
+                    METRICS.inc('rss_fetches_total', status='error')
+                    continue
+                self.feed_statuses[rss_feed] = status
+                METRICS.inc('rss_fetches_total', status=status)
+                if status == 'not_modified':
+                    logger.info(f'Feed {rss_feed} not modified, skipping')
+                    continue
+                rows_by_feed[rss_feed] = feed_rows
+                if validators['etag'] or validators['last_modified']:
+                    self._feed_state[rss_feed] = validators
+                else:
+                    self._feed_state.pop(rss_feed, None)
+        # keep the order of the feeds list regardless of which fetch finished first
+        rows = [row for rss_feed in self.rss_feeds for row in rows_by_feed.get(rss_feed, [])]
+        self._news_df = pd.DataFrame(rows, columns=NEWS_COLUMNS)
+        return self._news_df
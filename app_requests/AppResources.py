@@ -0,0 +1,112 @@
+import hashlib
+import json
+import logging
+
+from LLM_interactions.BatchRecommender import BatchRecommender
+from LLM_interactions.GPTRecommender import GPTRecommender
+from LLM_interactions.LLMClient import LLMClient
+from LLM_interactions.Ranker import make_ranker
+from LLM_interactions.RecommendationStore import RecommendationStore
+from LLM_interactions.RecommendationTemplateConstructor import RecommendationTemplateConstructor
+from LLM_interactions.TokenBudget import TokenBudget
+from LLM_interactions.TopicCache import TopicCache
+from app_requests.InteractionStore import InteractionStore
+from vector_database.IngestionScheduler import IngestionScheduler
+from vector_database.NewsVectorStorage import NewsVectorStorage
+
+
+def configure_logging(log_filename="logs.log") -> None:
+    """Attaches a single file handler for the whole application. Safe to call more than once."""
+    root_logger = logging.getLogger()
+    for handler in root_logger.handlers:
+        if getattr(handler, "_news_recommender", False):
+            return
+    fh = logging.FileHandler(log_filename)
+    fh._news_recommender = True
+    fh.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+    root_logger.addHandler(fh)
+    root_logger.setLevel(logging.INFO)
+
+
+class AppResources:
+    """Process-lifetime resources shared by all requests: one pooled async GPT client, one vector storage handle,
+    the parsed prompt templates, the prompt token budget, the topic cache, the interaction store, the per-user
+    recommendation store and the logging setup. Created once in the FastAPI lifespan.
+
+    Args:
+        last_days_interaction (int, optional): window of the interaction history used for prompts. Defaults to 7.
+        log_filename (str, optional): file all application logs go to. Defaults to "logs.log".
+        topic_cache_path (str, optional): SQLite file of the on-disk topic cache tier. None keeps it in memory only.
+        llm_max_concurrency (int, optional): maximum GPT calls in flight across all requests. Defaults to 16.
+        llm_base_url (str, optional): OpenAI-compatible endpoint. Defaults to the OpenAI API.
+        recommendation_store_path (str, optional): SQLite file keeping the served recommendations across restarts. None keeps them in memory only.
+        ranking_mode (str, optional): "gpt" (GPT picks and explains), "local" (embedding similarity, no LLM) or
+            "hybrid" (local picks, GPT explains). Defaults to "gpt".
+        prompt_token_budget (int, optional): maximum tokens of one prompt, the interaction history is truncated to fit. Defaults to 2000.
+    """
+    def __init__(self, last_days_interaction=7, log_filename="logs.log",
+                 topic_cache_path="LLM_interactions/topic_cache.sqlite3", llm_max_concurrency=16, llm_base_url=None,
+                 recommendation_store_path="LLM_interactions/recommendations.sqlite3", ranking_mode="gpt",
+                 prompt_token_budget=2000) -> None:
+        configure_logging(log_filename)
+        self.last_days_interaction = last_days_interaction
+        self.llm_client = LLMClient(max_concurrency=llm_max_concurrency, base_url=llm_base_url)
+        self.news_vector_storage = NewsVectorStorage()
+        self.ranker = make_ranker(ranking_mode, self.news_vector_storage, self.llm_client)
+        self.templates = RecommendationTemplateConstructor.read_templates()
+        self.token_budget = TokenBudget(max_prompt_tokens=prompt_token_budget)
+        self.topic_cache = TopicCache(disk_path=topic_cache_path)
+        self.interaction_store = InteractionStore()
+        self.recommendation_store = RecommendationStore(compute=self._compute_recommendations,
+                                                        fingerprint=self.recommendation_fingerprint,
+                                                        disk_path=recommendation_store_path)
+        self.ingestion_scheduler = IngestionScheduler(news_vector_storage=self.news_vector_storage,
+                                                      on_ingested=self._on_ingested)
+
+    def template_constructor(self) -> RecommendationTemplateConstructor:
+        return RecommendationTemplateConstructor(last_days_interaction=self.last_days_interaction, templates=self.templates,
+                                                 interaction_store=self.interaction_store, token_budget=self.token_budget)
+
+    def recommender(self) -> GPTRecommender:
+        """A fresh per-request recommender on top of the shared resources"""
+        return GPTRecommender(template_constructor=self.template_constructor(),
+                              llm_client=self.llm_client,
+                              news_vector_storage=self.news_vector_storage,
+                              topic_cache=self.topic_cache,
+                              ranker=self.ranker)
+
+    def batch_recommender(self, max_users_in_flight=64) -> BatchRecommender:
+        """A fresh batch recommender on top of the shared resources, storing its results in the recommendation store"""
+        return BatchRecommender(recommender_factory=self.recommender,
+                                news_vector_storage=self.news_vector_storage,
+                                recommendation_store=self.recommendation_store,
+                                max_users_in_flight=max_users_in_flight)
+
+    async def _compute_recommendations(self, user_id: str) -> dict:
+        return await self.recommender().get_recommendations(user_id=user_id)
+
+    async def stream_recommendations(self, user_id: str):
+        """Yields the user's recommendations article by article: replayed from the recommendation store when they
+        are fresh, otherwise streamed from the pipeline as GPT writes them, as the user's single-flight refresh"""
+        async for article in self.recommendation_store.stream(user_id, self._stream_recommendations):
+            yield article
+
+    def _stream_recommendations(self, user_id: str):
+        return self.recommender().stream_recommendations(user_id)
+
+    def recommendation_fingerprint(self, user_id: str) -> str:
+        """Fingerprint of everything a user's recommendations depend on: windowed clicks, preferences and the stored news"""
+        prompt_inputs = self.template_constructor().get_topics_prompt_inputs(user_id)
+        inputs = [prompt_inputs["articles"], prompt_inputs["preferences"], NewsVectorStorage.read_news_version()]
+        return hashlib.sha256(json.dumps(inputs).encode('utf-8')).hexdigest()
+
+    def _on_ingested(self, load_counts: dict) -> None:
+        if load_counts["inserted"] or load_counts["updated"] or load_counts["expired"]:
+            self.recommendation_store.refresh_active_threadsafe()
+
+    async def close(self) -> None:
+        await self.recommendation_store.close()
+        await self.llm_client.close()
+        self.topic_cache.close()
+        self.interaction_store.close()
+        self.news_vector_storage.close()
@@ -0,0 +1,6 @@
+from pydantic import BaseModel
+
+# model app POST request to compute recommendations for many users at once
+class BatchRecommendationRequest(BaseModel):
+    user_ids: list[str]
+    force: bool = False
@@ -0,0 +1,124 @@
+import glob
+import logging
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+import pandas as pd
+
+from app_requests.Metrics import METRICS
+
+logger = logging.getLogger(__name__)
+
+
+class InteractionStore:
+    """Append-only store of the articles users clicked on, backed by SQLite in WAL mode.
+
+    A click is a single-row INSERT, so it costs O(1) whatever the history length and concurrent clicks never
+    overwrite each other. Reads are range scans over an index on (user_id, date_ts). The per-user CSV files
+    of the former storage are imported once, on first use.
+
+    Args:
+        db_path (str, optional): SQLite database file. Defaults to 'LLM_interactions/UserInteractionHistory/interactions.sqlite3'.
+        csv_dir (str, optional): directory with the legacy *_interactions_history.csv files. None skips the migration.
+    """
+    def __init__(self, db_path='LLM_interactions/UserInteractionHistory/interactions.sqlite3',
+                 csv_dir='LLM_interactions/UserInteractionHistory') -> None:
+        self._db_path = db_path
+        self._local = threading.local()
+        connection = self._connection()
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.executescript("""
+            CREATE TABLE IF NOT EXISTS interactions (
+                id INTEGER PRIMARY KEY,
+                user_id TEXT NOT NULL,
+                title TEXT NOT NULL,
+                domain TEXT NOT NULL,
+                date TEXT NOT NULL,
+                date_ts REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS interactions_user_date ON interactions (user_id, date_ts);
+            CREATE TABLE IF NOT EXISTS migrated_csv (user_id TEXT PRIMARY KEY);
+        """)
+        if csv_dir is not None:
+            self.migrate_csvs(csv_dir)
+
+    def _connection(self) -> sqlite3.Connection:
+        # sqlite connections must not be shared between threads, FastAPI serves sync routes from a thread pool
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self._db_path, timeout=30, isolation_level=None)
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    @staticmethod
+    def date_timestamp(date: str):
+        """Parses a click date as sent by the app (day first, e.g. 24.03.2024) to unix time, None when it is empty or unparseable"""
+        try:
+            return datetime.strptime(date, "%d.%m.%Y").timestamp()
+        except (TypeError, ValueError):
+            parsed = pd.to_datetime(date, dayfirst=True, errors='coerce')
+            return None if pd.isna(parsed) else parsed.to_pydatetime().timestamp()
+
+    def append(self, user_id: str, title: str, domain: str, date: str) -> None:
+        """Stores one click. Clicks with an unparseable date could never fall into a time window, they are skipped."""
+        date_ts = self.date_timestamp(date)
+        if date_ts is None:
+            logger.warning(f"Skipping click of user {user_id} on {title!r}, unparseable date {date!r}")
+            return
+        with METRICS.span('interaction_store_write'):
+            self._connection().execute("INSERT INTO interactions (user_id, title, domain, date, date_ts) VALUES (?, ?, ?, ?, ?)",
+                                       (user_id, title, domain, date, date_ts))
+
+    def get_window(self, user_id: str, last_days: float) -> pd.DataFrame:
+        """Returns the interactions of the user from the last last_days days, oldest first
+
+        Returns:
+            pd.DataFrame: title, date and domain columns
+        """
+        since = time.time() - last_days * 24 * 60 * 60
+        with METRICS.span('interaction_store_read'):
+            rows = self._connection().execute("SELECT title, date_ts, domain FROM interactions WHERE user_id = ? AND date_ts >= ? ORDER BY date_ts",
+                                              (user_id, since)).fetchall()
+        return pd.DataFrame([(title, datetime.fromtimestamp(date_ts), domain) for title, date_ts, domain in rows],
+                            columns=["title", "date", "domain"])
+
+    def migrate_csvs(self, csv_dir: str) -> int:
+        """Imports the legacy per-user CSV histories that were not imported yet, each in its own transaction.
+        Rows with an unparseable date are skipped with a warning.
+
+        Returns:
+            int: number of imported files
+        """
+        connection = self._connection()
+        migrated = 0
+        for csv_path in glob.glob(os.path.join(csv_dir, '*_interactions_history.csv')):
+            user_id = os.path.basename(csv_path)[:-len('_interactions_history.csv')]
+            # BEGIN IMMEDIATE serializes workers starting at the same time, so a file is imported only once
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                if connection.execute("SELECT 1 FROM migrated_csv WHERE user_id = ?", (user_id,)).fetchone() is None:
+                    history = pd.read_csv(csv_path, dtype=str).fillna("")
+                    rows = [(user_id, row.title, row.domain, row.date, self.date_timestamp(row.date))
+                            for row in history.itertuples(index=False)]
+                    skipped = sum(row[-1] is None for row in rows)
+                    if skipped:
+                        logger.warning(f"Skipping {skipped} rows with an unparseable date in {csv_path}")
+                    connection.executemany("INSERT INTO interactions (user_id, title, domain, date, date_ts) VALUES (?, ?, ?, ?, ?)",
+                                           [row for row in rows if row[-1] is not None])
+                    connection.execute("INSERT INTO migrated_csv VALUES (?)", (user_id,))
+                    migrated += 1
+                connection.execute("COMMIT")
+            except Exception:
+                connection.execute("ROLLBACK")
+                raise
+        return migrated
+
+    def close(self) -> None:
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None:
+            connection.close()
+            self._local.connection = None
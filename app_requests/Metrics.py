@@ -0,0 +1,136 @@
+import contextvars
+import os
+import resource
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+TIME_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# stage durations of the request being served, None outside of a request
+_request_timings = contextvars.ContextVar('request_timings', default=None)
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels: tuple, extra='') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in labels]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Metrics:
+    """Counters and histograms of the whole process, rendered in the Prometheus text format.
+
+    Recording is a dict lookup and an increment under a lock, cheap enough to time every stage of every request.
+    Histograms keep per-bucket counts and are only made cumulative when rendered. Timing spans also add their
+    duration to the breakdown of the request being served, see start_request_timings.
+
+    Args:
+        prefix (str, optional): prepended to every metric name. Defaults to "news_".
+    """
+    def __init__(self, prefix='news_') -> None:
+        self._prefix = prefix
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._buckets = {}
+        self._help = {}
+        self.describe('stage_duration_seconds', 'Duration of the pipeline stages')
+
+    def describe(self, name: str, help: str, buckets=TIME_BUCKETS) -> None:
+        """Sets the help text of a metric and, for histograms, its bucket upper bounds"""
+        self._help[name] = help
+        self._buckets[name] = tuple(buckets)
+
+    def inc(self, name: str, value=1.0, **labels) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0.0) + value
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        buckets = self._buckets.get(name, TIME_BUCKETS)
+        key = (name, tuple(sorted(labels.items())))
+        # index len(buckets) is the +Inf bucket
+        bucket = bisect_left(buckets, value)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [[0] * (len(buckets) + 1), 0.0, 0]
+            histogram[0][bucket] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    @contextmanager
+    def span(self, stage: str, **labels):
+        """Times the enclosed block into stage_duration_seconds{stage=...}, failed blocks included"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            self.observe('stage_duration_seconds', elapsed, stage=stage, **labels)
+            timings = _request_timings.get()
+            if timings is not None:
+                timings[stage] = timings.get(stage, 0.0) + elapsed
+
+    @staticmethod
+    def start_request_timings() -> dict:
+        """Starts the per-stage breakdown of the current request. Spans in tasks and threads started from here
+        (asyncio.to_thread copies the context) add to the returned dict."""
+        timings = {}
+        _request_timings.set(timings)
+        return timings
+
+    @staticmethod
+    def server_timing_header(timings: dict) -> str:
+        """Formats a breakdown as a Server-Timing header value, durations in milliseconds"""
+        return ', '.join(f'{stage};dur={seconds * 1000:.1f}' for stage, seconds in timings.items())
+
+    def _process_lines(self) -> list:
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        lines = [f'# TYPE {self._prefix}process_cpu_seconds_total counter',
+                 f'{self._prefix}process_cpu_seconds_total {usage.ru_utime + usage.ru_stime}']
+        try:
+            with open('/proc/self/statm') as statm:
+                resident_bytes = int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+            lines += [f'# TYPE {self._prefix}process_resident_memory_bytes gauge',
+                      f'{self._prefix}process_resident_memory_bytes {resident_bytes}']
+        except OSError:
+            pass
+        return lines
+
+    def render(self) -> str:
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted((key, (list(counts), total, count)) for key, (counts, total, count) in self._histograms.items())
+        lines, described = [], set()
+
+        def header(name, kind):
+            if name not in described:
+                described.add(name)
+                if name in self._help:
+                    lines.append(f'# HELP {self._prefix}{name} {self._help[name]}')
+                lines.append(f'# TYPE {self._prefix}{name} {kind}')
+
+        for (name, labels), value in counters:
+            header(name, 'counter')
+            lines.append(f'{self._prefix}{name}{_format_labels(labels)} {value}')
+        for (name, labels), (counts, total, count) in histograms:
+            header(name, 'histogram')
+            cumulative = 0
+            for upper_bound, bucket_count in zip(self._buckets.get(name, TIME_BUCKETS) + ('+Inf',), counts):
+                cumulative += bucket_count
+                bucket_labels = _format_labels(labels, 'le="' + str(upper_bound) + '"')
+                lines.append(f'{self._prefix}{name}_bucket{bucket_labels} {cumulative}')
+            lines.append(f'{self._prefix}{name}_sum{_format_labels(labels)} {total}')
+            lines.append(f'{self._prefix}{name}_count{_format_labels(labels)} {count}')
+        return '\n'.join(lines + self._process_lines()) + '\n'
+
+
+# shared by every module of the process
+METRICS = Metrics()
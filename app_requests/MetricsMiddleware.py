@@ -0,0 +1,47 @@
+import time
+
+from app_requests.Metrics import METRICS
+
+
+class MetricsMiddleware:
+    """Plain ASGI middleware timing every HTTP request into http_request_duration_seconds{method, route, status}.
+
+    Labels use the route template (e.g. /get_recommendations/{user_id}), so the number of series stays bounded.
+    When server_timing is on, responses carry a Server-Timing header with the per-stage breakdown of the request.
+
+    Args:
+        app: the wrapped ASGI application
+        metrics (Metrics, optional): where the durations go. Defaults to the process-wide METRICS.
+        server_timing (bool, optional): adds the Server-Timing header to the responses. Defaults to False.
+    """
+    def __init__(self, app, metrics=METRICS, server_timing=False) -> None:
+        self.app = app
+        self._metrics = metrics
+        self._server_timing = server_timing
+        self._metrics.describe('http_request_duration_seconds', 'Duration of the HTTP requests, until the response is sent')
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        timings = self._metrics.start_request_timings()
+        started = time.perf_counter()
+        status = 500
+
+        async def send_with_timings(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+                if self._server_timing:
+                    timings['total'] = time.perf_counter() - started
+                    header = self._metrics.server_timing_header(timings).encode('latin-1')
+                    message = {**message, 'headers': [*message.get('headers', []), (b'server-timing', header)]}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timings)
+        finally:
+            # the router stores the matched route in the scope
+            route = scope.get('route')
+            self._metrics.observe('http_request_duration_seconds', time.perf_counter() - started,
+                                  method=scope['method'], route=getattr(route, 'path', 'unmatched'), status=str(status))
@@ -0,0 +1,45 @@
+"""Computes the recommendations of many users at once: python batch_recommendations.py user_ids.txt > recommendations.ndjson
+
+User IDs are read one per line from the given files, or from stdin when there are none. Every user's result is
+written as one JSON line as soon as it is ready, and stored like a served request, so the users' next
+/get_recommendations calls are answered from the store. Throughput is reported on stderr in users per minute.
+"""
+import argparse
+import asyncio
+import fileinput
+import json
+import os
+import sys
+import time
+
+from app_requests.AppResources import AppResources
+
+
+async def run(user_ids: list, force=False, max_users_in_flight=64, llm_max_concurrency=16) -> int:
+    """Returns the number of users whose recommendations failed"""
+    resources = AppResources(llm_max_concurrency=llm_max_concurrency, ranking_mode=os.environ.get("RANKING_MODE", "gpt"))
+    started, done, failed = time.perf_counter(), 0, 0
+    try:
+        async for result in resources.batch_recommender(max_users_in_flight=max_users_in_flight).stream(user_ids, force=force):
+            sys.stdout.write(json.dumps(result) + "\n")
+            sys.stdout.flush()
+            done += 1
+            failed += "error" in result
+    finally:
+        await resources.close()
+    elapsed = time.perf_counter() - started
+    print(f"{done} users ({failed} failed) in {elapsed:.1f}s, {done / elapsed * 60:.0f} users per minute", file=sys.stderr)
+    return failed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('files', nargs='*', help='files with one user ID per line, stdin when none')
+    parser.add_argument('--force', action='store_true', help='recompute the stored recommendations that are still fresh too')
+    parser.add_argument('--max-users-in-flight', type=int, default=64)
+    parser.add_argument('--llm-max-concurrency', type=int, default=16)
+    args = parser.parse_args()
+    user_ids = [line.strip() for line in fileinput.input(args.files) if line.strip()]
+    failed = asyncio.run(run(user_ids, force=args.force, max_users_in_flight=args.max_users_in_flight,
+                             llm_max_concurrency=args.llm_max_concurrency))
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,135 @@
+"""Micro-benchmark of the per-request path from the query results to the response JSON: python -m benchmarks.CandidatePathBenchmark
+
+Runs the non-LLM part of one recommendation request after the fusion of the topic results (see QueryTopicsBenchmark),
+i.e. building the candidates, listing their titles for the prompt, mapping the ranker's IDs back to articles and
+building the response with the random diversification articles, once through the former pandas DataFrames and once
+through Candidates. Reports the CPU time and the peak traced memory per request, and checks both give the same
+response JSON. Synthetic results, so no vector database, embedding model or LLM is needed.
+"""
+import argparse
+import json
+import math
+import time
+import timeit
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+from LLM_interactions.GPTRecommender import GPTRecommender
+from benchmarks.QueryTopicsBenchmark import make_results
+from vector_database.Candidates import Candidates
+from vector_database.NewsVectorStorage import NewsVectorStorage
+
+RANDOM_EXPLANATION = "We thought you might like these articles as well."
+
+
+def make_random_metadatas(n=5) -> list:
+    """Stored metadatas of the random diversification articles, internal fields included"""
+    return [{'link': f'https://random.local/{index}', 'domain': 'random.local', 'published': 'Mon, 01 Apr 2024 10:00:00 +0000',
+             'title': f'Random {index}', 'summary': f'Summary {index}', 'content_hash': f'{index:064x}',
+             'published_ts': 1711965600.0, 'alternate_sources': json.dumps([{'link': f'https://mirror.local/{index}',
+                                                                              'domain': 'mirror.local', 'title': f'Random {index}'}])}
+            for index in range(n)]
+
+
+def make_ranking(n_candidates: int, n_recommendations=10) -> dict:
+    """A ranker answer with a repeated and an out of range ID, as GPT sometimes returns"""
+    ids = list(range(1, min(n_recommendations, n_candidates) + 1)) + [1, n_candidates + 5]
+    return {"ids": ids, "explanations": [f"Explanation {id}" for id in ids]}
+
+
+def legacy_metadata_dataframe(metadatas: list) -> pd.DataFrame:
+    df = pd.DataFrame(metadatas).drop(columns=['content_hash', 'published_ts'], errors='ignore')
+    sources = df['alternate_sources'] if 'alternate_sources' in df else [None] * len(df)
+    df['alternate_sources'] = [[{key: source[key] for key in ('link', 'domain', 'title')} for source in json.loads(value)]
+                               if isinstance(value, str) else [] for value in sources]
+    return df
+
+
+def legacy_request(fused: dict, random_metadatas: list, ranking: dict, articles_limit=30) -> dict:
+    selected = np.arange(min(articles_limit, len(fused['distances'])))
+    candidates = legacy_metadata_dataframe([fused['metadatas'][index] for index in selected])
+    candidates.insert(0, 'distance', fused['distances'][selected])
+    candidates['title'].tolist()  # prompt
+
+    positions, picked_titles, picked_explanations = [], set(), []
+    for id, explanation in zip(ranking["ids"], ranking["explanations"]):
+        position = int(id) - 1
+        if not 0 <= position < len(candidates) or candidates['title'].iat[position] in picked_titles:
+            continue
+        picked_titles.add(candidates['title'].iat[position])
+        positions.append(position)
+        picked_explanations.append(explanation)
+    recommended = candidates.iloc[positions].reset_index(drop=True)
+
+    recommended.drop_duplicates(subset=['title'], inplace=True)
+    recommended["explanations"] = picked_explanations
+    recommended["link"].tolist()  # ids to exclude from the random articles
+    random_articles = legacy_metadata_dataframe(random_metadatas)
+    random_articles["distance"] = 0
+    random_articles["explanations"] = RANDOM_EXPLANATION
+    recommended = pd.concat([recommended, random_articles], ignore_index=True)
+    return {key: list(value.values()) for key, value in recommended.to_dict().items()}
+
+
+class _RandomArticles:
+    """Answers query_random from fixed metadatas, like the vector storage would"""
+    def __init__(self, metadatas: list) -> None:
+        self._metadatas = metadatas
+
+    def query_random(self, articles_limit=30, ids_to_exclude=None):
+        return Candidates.from_metadatas(self._metadatas[:articles_limit])
+
+
+def candidates_request(recommender: GPTRecommender, fused: dict, ranking: dict, articles_limit=30) -> dict:
+    selected = np.arange(min(articles_limit, len(fused['distances'])))
+    candidates = Candidates.from_metadatas([fused['metadatas'][index] for index in selected], fused['distances'][selected].tolist())
+    candidates.title  # prompt
+    recommended, explanations = recommender._select_recommended(candidates, ranking["ids"], ranking["explanations"])
+    return recommender.prepare_response_json(recommended, explanations)
+
+
+def normalized(payload: dict) -> str:
+    return json.dumps(payload, sort_keys=True, default=float)
+
+
+def peak_bytes(fn) -> int:
+    """Peak memory traced while fn runs, above what was allocated before"""
+    tracemalloc.start()
+    try:
+        baseline, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        fn()
+        return tracemalloc.get_traced_memory()[1] - baseline
+    finally:
+        tracemalloc.stop()
+
+
+def run(articles_limit=30, repeat=200) -> list:
+    random_metadatas = make_random_metadatas()
+    recommender = GPTRecommender(template_constructor=None, llm_client=object(), ranker=object(),
+                                 news_vector_storage=_RandomArticles(random_metadatas))
+    rows = []
+    for n_topics in (1, 5, 15):
+        fused = NewsVectorStorage._fuse_topic_results(make_results(n_topics, max(math.ceil(articles_limit * 1.5 / n_topics), 3)))
+        ranking = make_ranking(min(articles_limit, len(fused['distances'])))
+        paths = (('pandas', lambda: legacy_request(fused, random_metadatas, ranking, articles_limit)),
+                 ('candidates', lambda: candidates_request(recommender, fused, ranking, articles_limit)))
+        payloads = [normalized(fn()) for _, fn in paths]
+        if payloads[0] != payloads[1]:
+            raise AssertionError(f"The response JSON differs between the paths for {n_topics} topics")
+        for name, fn in paths:
+            seconds = min(timeit.repeat(fn, timer=time.process_time, number=repeat, repeat=3)) / repeat
+            rows.append({'topics': n_topics, 'path': name, 'candidates': min(articles_limit, len(fused['distances'])),
+                         'articles': len(json.loads(payloads[0])['link']),
+                         'cpu_us_per_request': round(seconds * 1e6, 1), 'peak_kib_per_request': round(peak_bytes(fn) / 1024, 1)})
+    return rows
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--articles-limit', type=int, default=30)
+    parser.add_argument('--repeat', type=int, default=200)
+    args = parser.parse_args()
+    print(pd.DataFrame(run(args.articles_limit, args.repeat)).to_string(index=False))
@@ -0,0 +1,332 @@
+"""Offline end-to-end benchmark: python -m benchmarks.EndToEndBenchmark [--output run.json] [--compare baseline.json]
+
+Drives every stage of the application against local stand-ins, so neither RSS feeds nor OpenAI are needed:
+generated feeds served by FixtureFeedServer, the OpenAI-compatible StubLLMServer with a fixed latency, and a
+Chroma store in a temporary directory. Chroma's embedding model must already be in its local cache.
+
+Stages: NewsRetriever.retrieve_news, NewsVectorStorage.load_news (first load and unchanged reloads),
+query_topics, query_random, save_user_click, then the FastAPI endpoints under concurrent HTTP load, served by
+uvicorn, including streamed recommendations and one batch recommendation request for all users. Every stage
+reports its throughput, p50/p95/p99 latency and the process memory. Results are saved as JSON; --compare flags
+the stages that got slower than in an earlier run and exits with status 1.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+import httpx
+import numpy as np
+import uvicorn
+
+from app_requests.AppInformationHandler import AppInformationHandler
+from app_requests.InteractionStore import InteractionStore
+from app_requests.UserClick import UserClick
+from benchmarks.FixtureFeedServer import FixtureFeedServer, generate_feed
+from benchmarks.StubLLMServer import StubLLMServer
+from RSS_feed_collector.NewsRetriever import NewsRetriever
+from vector_database.NewsVectorStorage import NewsVectorStorage
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def rss_mb() -> float:
+    """Current resident memory of the process, falls back to the peak where /proc is not available"""
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+    except OSError:
+        return peak_rss_mb()
+
+
+def peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes elsewhere
+    return peak / 2 ** 20 if platform.system() == 'Darwin' else peak / 2 ** 10
+
+
+def stage_result(latencies: list, elapsed: float, items: int, errors=0) -> dict:
+    """Throughput in items per second, latency percentiles in milliseconds and the memory after the stage"""
+    latencies_ms = np.asarray(latencies, dtype=np.float64) * 1000
+    p50, p95, p99 = np.percentile(latencies_ms, [50, 95, 99]) if len(latencies_ms) else (0.0, 0.0, 0.0)
+    return {'calls': len(latencies), 'items': items, 'errors': errors, 'seconds': round(elapsed, 3),
+            'throughput_per_s': round(items / elapsed, 1) if elapsed else 0.0,
+            'p50_ms': round(float(p50), 2), 'p95_ms': round(float(p95), 2), 'p99_ms': round(float(p99), 2),
+            'rss_mb': round(rss_mb(), 1), 'peak_rss_mb': round(peak_rss_mb(), 1)}
+
+
+def timed_calls(fn, n_calls: int) -> tuple:
+    """Calls fn() n_calls times, returns (latencies, elapsed, last result)"""
+    latencies, result = [], None
+    started = time.perf_counter()
+    for _ in range(n_calls):
+        call_started = time.perf_counter()
+        result = fn()
+        latencies.append(time.perf_counter() - call_started)
+    return latencies, time.perf_counter() - started, result
+
+
+@contextmanager
+def sandbox(feed_urls: list):
+    """Temporary working directory laid out like the repository, the application only uses relative paths"""
+    previous_cwd = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix='news-benchmark-') as root:
+        for directory in ('vector_database', 'RSS_feed_collector', 'LLM_interactions/UserPreferences',
+                          'LLM_interactions/UserInteractionHistory'):
+            os.makedirs(os.path.join(root, directory))
+        shutil.copytree(os.path.join(REPO_ROOT, 'LLM_interactions', 'templates'), os.path.join(root, 'LLM_interactions', 'templates'))
+        with open(os.path.join(root, 'RSS_feed_collector', 'rss_feeds.txt'), 'w') as file:
+            file.write('\n'.join(feed_urls))
+        os.chdir(root)
+        try:
+            yield root
+        finally:
+            os.chdir(previous_cwd)
+
+
+def bench_retrieval(feed_urls: list, repeat: int) -> tuple:
+    # no feed state, every round downloads and parses all feeds
+    retrieve = lambda: NewsRetriever(feed_urls, feed_state_path=None).retrieve_news()
+    latencies, elapsed, news_df = timed_calls(retrieve, repeat)
+    return stage_result(latencies, elapsed, len(news_df) * repeat), news_df
+
+
+def bench_loading(news_vector_storage: NewsVectorStorage, news_df, reload_repeat: int) -> tuple:
+    first_latencies, first_elapsed, load_counts = timed_calls(lambda: news_vector_storage.load_news(news_df), 1)
+    reload_latencies, reload_elapsed, _ = timed_calls(lambda: news_vector_storage.load_news(news_df), reload_repeat)
+    return {'load_news_first': stage_result(first_latencies, first_elapsed, len(news_df)),
+            'load_news_unchanged': stage_result(reload_latencies, reload_elapsed, len(news_df) * reload_repeat)}, load_counts
+
+
+def bench_queries(news_vector_storage: NewsVectorStorage, topic_pool: list, n_queries: int, seed=0) -> dict:
+    rng = random.Random(seed)
+    topics = lambda: news_vector_storage.query_topics(rng.sample(topic_pool, rng.randint(1, min(5, len(topic_pool)))),
+                                                      mmr_lambda=0.7)
+    topic_latencies, topic_elapsed, _ = timed_calls(topics, n_queries)
+    random_latencies, random_elapsed, _ = timed_calls(lambda: news_vector_storage.query_random(30), n_queries)
+    return {'query_topics': stage_result(topic_latencies, topic_elapsed, n_queries),
+            'query_random': stage_result(random_latencies, random_elapsed, n_queries)}
+
+
+def bench_clicks(n_clicks: int, n_users: int) -> dict:
+    interaction_store = InteractionStore(csv_dir=None)
+    today = time.strftime('%d.%m.%Y')
+    clicks = [UserClick(user_id=f'click_user_{i % n_users}', title=f'Clicked article {i}', date=today, domain='fixture.local')
+              for i in range(n_clicks)]
+    clicks_iter = iter(clicks)
+    latencies, elapsed, _ = timed_calls(lambda: AppInformationHandler.save_user_click(next(clicks_iter), interaction_store), n_clicks)
+    interaction_store.close()
+    return {'save_user_click': stage_result(latencies, elapsed, n_clicks)}
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+@contextmanager
+def serve_app():
+    """Runs the FastAPI app with uvicorn in a background thread, lifespan included"""
+    from main import app
+
+    port = free_port()
+    server = uvicorn.Server(uvicorn.Config(app, host='127.0.0.1', port=port, log_level='warning'))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        if not thread.is_alive():
+            raise RuntimeError('uvicorn did not start')
+        time.sleep(0.05)
+    try:
+        yield app, f'http://127.0.0.1:{port}'
+    finally:
+        server.should_exit = True
+        thread.join()
+
+
+async def http_load(base_url: str, requests: list, concurrency: int) -> dict:
+    """Sends (method, path, json) requests with at most concurrency of them in flight"""
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies, errors = [], 0
+
+    async def send(client, method, path, body):
+        nonlocal errors
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                response = await client.request(method, path, json=body)
+                if response.status_code != 200:
+                    errors += 1
+            except httpx.HTTPError:
+                errors += 1
+            latencies.append(time.perf_counter() - started)
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=300) as client:
+        started = time.perf_counter()
+        await asyncio.gather(*(send(client, method, path, body) for method, path, body in requests))
+        elapsed = time.perf_counter() - started
+    return stage_result(latencies, elapsed, len(requests), errors)
+
+
+async def http_stream(base_url: str, user_ids: list, concurrency: int) -> dict:
+    """Streams the recommendations of every user, the latency of a user is the time until its first article arrived"""
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies, errors = [], 0
+
+    async def stream(client, user_id):
+        nonlocal errors
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                async with client.stream('GET', f'/stream_recommendations/{user_id}') as response:
+                    async for line in response.aiter_lines():
+                        if line:
+                            latencies.append(time.perf_counter() - started)
+                            break
+                    else:
+                        errors += 1
+            except httpx.HTTPError:
+                errors += 1
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=300) as client:
+        started = time.perf_counter()
+        await asyncio.gather(*(stream(client, user_id) for user_id in user_ids))
+        elapsed = time.perf_counter() - started
+    return stage_result(latencies, elapsed, len(user_ids), errors)
+
+
+async def http_batch(base_url: str, user_ids: list) -> dict:
+    """Streams one batch request, the latency of a user is the time until its line arrived"""
+    latencies, errors = [], 0
+    async with httpx.AsyncClient(base_url=base_url, timeout=300) as client:
+        started = time.perf_counter()
+        async with client.stream('POST', '/get_recommendations_batch/', json={'user_ids': user_ids, 'force': True}) as response:
+            async for line in response.aiter_lines():
+                if line:
+                    latencies.append(time.perf_counter() - started)
+                    errors += 'error' in json.loads(line)
+        elapsed = time.perf_counter() - started
+    return stage_result(latencies, elapsed, len(latencies), errors + len(user_ids) - len(latencies))
+
+
+def bench_endpoints(base_url: str, n_users: int, clicks_per_user: int, concurrency: int) -> dict:
+    users = [f'http_user_{i}' for i in range(n_users)]
+    today = time.strftime('%d.%m.%Y')
+    clicks = [('POST', '/submit_user_click/', {'user_id': user, 'title': f'fixture_{i} article {i}', 'date': today, 'domain': 'fixture.local'})
+              for user in users for i in range(clicks_per_user)]
+    recommendations = [('GET', f'/get_recommendations/{user}', None) for user in users]
+    adjustments = [('POST', '/adjust_recommendations/', {'user_id': user, 'request': 'More science please'}) for user in users]
+    return {
+        'http_submit_user_click': asyncio.run(http_load(base_url, clicks, concurrency)),
+        # first request of every user runs the whole pipeline, the second one is served from the recommendation store
+        'http_get_recommendations_cold': asyncio.run(http_load(base_url, recommendations, concurrency)),
+        'http_get_recommendations_warm': asyncio.run(http_load(base_url, recommendations, concurrency)),
+        # users without stored recommendations, latency up to the first streamed article
+        'http_stream_recommendations_first_article': asyncio.run(
+            http_stream(base_url, [f'stream_user_{i}' for i in range(n_users)], concurrency)),
+        'http_adjust_recommendations': asyncio.run(http_load(base_url, adjustments, concurrency)),
+        # all users in one streamed request, topic queries and candidate pools shared across them
+        'http_get_recommendations_batch': asyncio.run(http_batch(base_url, users)),
+    }
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_ROOT, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(n_feeds=20, n_items=50, retrieve_repeat=3, reload_repeat=3, n_queries=200, n_clicks=2000, n_users=50,
+        clicks_per_user=5, concurrency=16, llm_latency=0.2, ranking_mode='gpt', syndicated_feeds=0) -> dict:
+    """Runs all stages and returns the results, see the module docstring"""
+    parameters = dict(locals())
+    feeds = {}
+    for i in range(n_feeds):
+        # the last syndicated_feeds feeds carry the stories of the first ones under their own links, as near-duplicates
+        stories_from = f'fixture_{i - n_feeds + syndicated_feeds}' if i >= n_feeds - syndicated_feeds else None
+        feeds[f'/fixture_{i}.xml'] = generate_feed(f'fixture_{i}', n_items=n_items, stories_from=stories_from)
+    stages = {}
+    with FixtureFeedServer(feeds) as feed_server, StubLLMServer(latency=llm_latency) as llm_server, \
+            sandbox(feed_server.urls()):
+        stages['retrieve_news'], news_df = bench_retrieval(feed_server.urls(), retrieve_repeat)
+        news_vector_storage = NewsVectorStorage()
+        loading_stages, load_counts = bench_loading(news_vector_storage, news_df, reload_repeat)
+        stages.update(loading_stages)
+        stages.update(bench_queries(news_vector_storage, [f'fixture_{i} article' for i in range(n_feeds)], n_queries))
+        stages.update(bench_clicks(n_clicks, n_users))
+
+        os.environ['OPENAI_BASE_URL'] = llm_server.base_url
+        os.environ['OPENAI_API_KEY'] = 'stub'
+        os.environ['RANKING_MODE'] = ranking_mode
+        with serve_app() as (app, base_url):
+            stages.update(bench_endpoints(base_url, n_users, clicks_per_user, concurrency))
+            prompt_tokens = app.state.resources.token_budget.stats()
+        llm_requests = llm_server.requests_served
+    return {'started': time.strftime('%Y-%m-%dT%H:%M:%S%z'), 'git_commit': git_commit(),
+            'python': platform.python_version(), 'platform': platform.platform(), 'parameters': parameters,
+            'llm_requests': llm_requests, 'prompt_tokens': prompt_tokens, 'load_counts': load_counts, 'stages': stages}
+
+
+def compare(results: dict, baseline: dict, tolerance=0.2) -> list:
+    """Stages that lost more than tolerance (relative) of their throughput, or whose p95 grew by more than that"""
+    regressions = []
+    for stage, current in results['stages'].items():
+        previous = baseline.get('stages', {}).get(stage)
+        if previous is None:
+            continue
+        if previous['throughput_per_s'] and current['throughput_per_s'] < previous['throughput_per_s'] * (1 - tolerance):
+            regressions.append(f"{stage}: throughput {previous['throughput_per_s']} -> {current['throughput_per_s']} /s")
+        if previous['p95_ms'] and current['p95_ms'] > previous['p95_ms'] * (1 + tolerance):
+            regressions.append(f"{stage}: p95 {previous['p95_ms']} -> {current['p95_ms']} ms")
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Offline end-to-end benchmark of the news recommender')
+    parser.add_argument('--output', default=f"end_to_end_{time.strftime('%Y%m%d-%H%M%S')}.json", help='JSON file for the results')
+    parser.add_argument('--compare', help='JSON results of an earlier run to check for regressions')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='relative slowdown reported as a regression')
+    parser.add_argument('--feeds', type=int, default=20)
+    parser.add_argument('--items', type=int, default=50, help='articles per feed')
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--llm-latency', type=float, default=0.2)
+    parser.add_argument('--ranking-mode', default='gpt', choices=['gpt', 'local', 'hybrid'])
+    parser.add_argument('--syndicated-feeds', type=int, default=0, help='feeds repeating the stories of other feeds')
+    args = parser.parse_args()
+    output_path = os.path.abspath(args.output)
+
+    results = run(n_feeds=args.feeds, n_items=args.items, n_users=args.users, concurrency=args.concurrency,
+                  llm_latency=args.llm_latency, ranking_mode=args.ranking_mode, syndicated_feeds=args.syndicated_feeds)
+    with open(output_path, 'w') as file:
+        json.dump(results, file, indent=2)
+
+    print(f"{'stage':42} {'items/s':>10} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'errors':>7} {'rss MB':>8}")
+    for stage, result in results['stages'].items():
+        print(f"{stage:42} {result['throughput_per_s']:>10} {result['p50_ms']:>9} {result['p95_ms']:>9} "
+              f"{result['p99_ms']:>9} {result['errors']:>7} {result['rss_mb']:>8}")
+    print(f"First load: {results['load_counts']}")
+    print(f"LLM requests: {results['llm_requests']}, prompt tokens: {results['prompt_tokens']}")
+    print(f'Results saved to {output_path}')
+
+    if args.compare:
+        with open(args.compare) as file:
+            regressions = compare(results, json.load(file), args.tolerance)
+        for regression in regressions:
+            print(f'REGRESSION {regression}')
+        raise SystemExit(1 if regressions else 0)
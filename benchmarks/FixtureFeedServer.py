@@ -0,0 +1,154 @@
+import hashlib
+import threading
+import time
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# words of the generated summaries, so that every article is a distinct story to the embedding model
+_SUMMARY_WORDS = ('election parliament vote minister budget tax inflation bank market shares oil energy climate storm flood '
+                  'wildfire drought harvest vaccine hospital virus study researchers telescope planet rocket satellite chip '
+                  'software startup lawsuit court judge police border refugees protest strike union wages factory trade '
+                  'tariff summit treaty army ceasefire museum festival film album tournament league transfer coach '
+                  'stadium railway airport airline housing rents mortgage school university exam dinosaur fossil ocean '
+                  'coral whale forest bridge earthquake volcano privacy hackers outage census recount senator mayor').split()
+
+
+def _summary(story: str, n_words=14) -> str:
+    digest = hashlib.sha256(story.encode('utf-8')).digest()
+    return ' '.join(_SUMMARY_WORDS[byte % len(_SUMMARY_WORDS)] for byte in digest[:n_words]).capitalize() + '.'
+
+
+def generate_feed(feed_name: str, n_items=20, domain='fixture.local', published=None, stories_from=None) -> bytes:
+    """Generates an RSS 2.0 document with n_items articles.
+
+    Args:
+        feed_name (str): name of the feed, used in titles and links so that feeds do not overlap
+        n_items (int, optional): number of articles in the feed. Defaults to 20.
+        domain (str, optional): domain of the article links. Defaults to 'fixture.local'.
+        published (float, optional): unix time used as the publication date of every article. Defaults to now.
+        stories_from (str, optional): name of another feed whose stories this one carries under its own links,
+            like syndicated wire copy. Defaults to None (own stories).
+    """
+    pub_date = formatdate(published if published is not None else time.time(), usegmt=True)
+    story_feed = stories_from if stories_from is not None else feed_name
+    items = ''.join(
+        f'<item><title>{story_feed} article {i}</title>'
+        f'<link>https://{domain}/{feed_name}/{i}</link>'
+        f'<description>{_summary(f"{story_feed} {i}")}</description>'
+        f'<pubDate>{pub_date}</pubDate></item>'
+        for i in range(n_items)
+    )
+    return (f'<?xml version="1.0" encoding="UTF-8"?><rss version="2.0"><channel>'
+            f'<title>{feed_name}</title><link>https://{domain}/{feed_name}</link>'
+            f'<description>Fixture feed</description>{items}</channel></rss>').encode('utf-8')
+
+
+class FixtureFeedServer:
+    """Serves fixture RSS feeds from a local HTTP server on a free port.
+    Honors If-None-Match/If-Modified-Since so conditional GET behaviour can be exercised.
+
+    Args:
+        feeds (dict): mapping of path (e.g. "/world.xml") to the feed body in bytes
+        delay (float, optional): seconds to sleep before answering every request. Defaults to 0.
+
+    Usage:
+        with FixtureFeedServer({"/world.xml": generate_feed("world")}) as server:
+            NewsRetriever(server.urls()).retrieve_news()
+    """
+    def __init__(self, feeds: dict, delay=0.0) -> None:
+        self.feeds = dict(feeds)
+        self.delay = delay
+        self.request_log = []
+        self._last_modified = formatdate(time.time(), usegmt=True)
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), self._make_handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def urls(self) -> list:
+        return [self.base_url + path for path in self.feeds]
+
+    def set_feed(self, path: str, body: bytes) -> None:
+        """Replaces a feed body, which changes its ETag and Last-Modified."""
+        self.feeds[path] = body
+        self._last_modified = formatdate(time.time() + 1, usegmt=True)
+
+    def _make_handler(self):
+        fixture = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if fixture.delay:
+                    time.sleep(fixture.delay)
+                body = fixture.feeds.get(self.path)
+                if body is None:
+                    fixture.request_log.append((self.path, 404))
+                    self.send_error(404)
+                    return
+                etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+                if self.headers.get('If-None-Match') == etag:
+                    fixture.request_log.append((self.path, 304))
+                    self.send_response(304)
+                    self.send_header('ETag', etag)
+                    self.end_headers()
+                    return
+                fixture.request_log.append((self.path, 200))
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/rss+xml')
+                self.send_header('Content-Length', str(len(body)))
+                self.send_header('ETag', etag)
+                self.send_header('Last-Modified', fixture._last_modified)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def start(self) -> 'FixtureFeedServer':
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+if __name__ == '__main__':
+    # Smoke harness for NewsRetriever: python -m benchmarks.FixtureFeedServer
+    import tempfile
+    import os
+    from RSS_feed_collector.NewsRetriever import NewsRetriever
+
+    feeds = {f'/feed_{i}.xml': generate_feed(f'feed_{i}', n_items=50) for i in range(10)}
+    feeds['/broken.xml'] = b'this is not a feed'
+    with FixtureFeedServer(feeds) as server, tempfile.TemporaryDirectory() as tmp_dir:
+        state_path = os.path.join(tmp_dir, 'feed_state.json')
+        urls = server.urls() + [server.base_url + '/missing.xml']
+
+        retriever = NewsRetriever(urls, feed_state_path=state_path, timeout=5)
+        news_df = retriever.retrieve_news()
+        retriever.save_feed_state()
+        assert len(news_df) == 500, len(news_df)
+        assert retriever.feed_statuses['/'.join([server.base_url, 'broken.xml'])] == 'error'
+        assert retriever.feed_statuses['/'.join([server.base_url, 'missing.xml'])] == 'error'
+
+        server.set_feed('/feed_0.xml', generate_feed('feed_0', n_items=60))
+        retriever = NewsRetriever(urls, feed_state_path=state_path, timeout=5)
+        news_df = retriever.retrieve_news()
+        assert len(news_df) == 60, len(news_df)
+        assert sum(status == 'not_modified' for status in retriever.feed_statuses.values()) == 9
+        print('NewsRetriever fixture harness passed')
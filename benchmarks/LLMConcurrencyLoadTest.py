@@ -0,0 +1,35 @@
+"""Load test of the async LLM path against the local stub server: python -m benchmarks.LLMConcurrencyLoadTest
+
+Fires a burst of concurrent calls through LLMClient for several concurrency limits and reports the throughput,
+which should grow with the limit until the burst size, since every call only waits on the stub's latency.
+"""
+import asyncio
+import time
+
+from LLM_interactions.LLMClient import LLMClient
+from benchmarks.StubLLMServer import StubLLMServer
+
+
+async def burst(base_url: str, max_concurrency: int, n_calls: int) -> float:
+    llm_client = LLMClient(max_concurrency=max_concurrency, base_url=base_url, api_key='stub')
+    started = time.perf_counter()
+    await asyncio.gather(*(llm_client.complete_json(f'Provide a list of topics #{i}') for i in range(n_calls)))
+    elapsed = time.perf_counter() - started
+    await llm_client.close()
+    return elapsed
+
+
+def run(latency=0.2, n_calls=64, concurrency_limits=(1, 4, 16, 64)) -> list:
+    rows = []
+    with StubLLMServer(latency=latency) as server:
+        for max_concurrency in concurrency_limits:
+            server.max_in_flight = 0
+            elapsed = asyncio.run(burst(server.base_url, max_concurrency, n_calls))
+            rows.append({'max_concurrency': max_concurrency, 'calls': n_calls, 'seconds': round(elapsed, 2),
+                         'calls_per_second': round(n_calls / elapsed, 1), 'max_in_flight_at_server': server.max_in_flight})
+    return rows
+
+
+if __name__ == '__main__':
+    for row in run():
+        print(row)
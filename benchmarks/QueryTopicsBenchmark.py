@@ -0,0 +1,67 @@
+"""Micro-benchmark of the query_topics post-processing: python -m benchmarks.QueryTopicsBenchmark
+
+Compares the former loop-and-pandas flattening with the vectorized fusion, with and without MMR,
+on synthetic Chroma query results, so no vector database or embedding model is needed.
+"""
+import math
+import timeit
+
+import numpy as np
+import pandas as pd
+
+from vector_database.Candidates import Candidates
+from vector_database.NewsVectorStorage import NewsVectorStorage
+
+
+def make_results(n_topics: int, per_topic_k: int, n_articles=500, dim=384, seed=0) -> dict:
+    """Synthetic output of collection.query with topics hitting overlapping articles"""
+    rng = np.random.default_rng(seed)
+    article_embeddings = rng.normal(size=(n_articles, dim)).astype(np.float32)
+    results = {'ids': [], 'distances': [], 'metadatas': [], 'embeddings': []}
+    for _ in range(n_topics):
+        hits = rng.choice(n_articles, size=per_topic_k, replace=False)
+        distances = np.sort(rng.uniform(0.5, 1.5, size=per_topic_k))
+        results['ids'].append([f'https://news.local/{hit}' for hit in hits])
+        results['distances'].append(distances.tolist())
+        results['metadatas'].append([{'link': f'https://news.local/{hit}', 'domain': 'news.local',
+                                      'published': 'Mon, 01 Apr 2024 10:00:00 +0000',
+                                      'title': f'Title {hit}', 'summary': f'Summary {hit}'} for hit in hits])
+        results['embeddings'].append([article_embeddings[hit] for hit in hits])
+    return results
+
+
+def legacy_post_processing(results, articles_limit=30) -> pd.DataFrame:
+    flattened_data = []
+    for dist_group, meta_group in zip(results['distances'], results['metadatas']):
+        flattened_data.extend({'distance': dist, **meta} for dist, meta in zip(dist_group, meta_group))
+    df = pd.DataFrame(flattened_data)
+    df = df.drop_duplicates(subset=['link'])
+    df.drop_duplicates(subset=['link'], inplace=True)
+    return df.sort_values(by='distance').head(articles_limit)
+
+
+def fused_post_processing(results, articles_limit=30, mmr_lambda=None) -> Candidates:
+    fused = NewsVectorStorage._fuse_topic_results(results)
+    if mmr_lambda is not None:
+        selected = NewsVectorStorage._mmr(fused['embeddings'], fused['distances'], articles_limit, mmr_lambda)
+    else:
+        selected = np.arange(min(articles_limit, len(fused['distances'])))
+    return Candidates.from_metadatas([fused['metadatas'][index] for index in selected], fused['distances'][selected].tolist())
+
+
+def run(articles_limit=30, oversample=1.5, repeat=200) -> list:
+    rows = []
+    for n_topics in (2, 5, 15):
+        per_topic_k = max(math.ceil(articles_limit * oversample / n_topics), 3)
+        results = make_results(n_topics, per_topic_k)
+        legacy_results = make_results(n_topics, 5)
+        for name, fn, res in (('legacy (k=5)', lambda r: legacy_post_processing(r, articles_limit), legacy_results),
+                              ('fused', lambda r: fused_post_processing(r, articles_limit), results),
+                              ('fused + mmr', lambda r: fused_post_processing(r, articles_limit, 0.7), results)):
+            seconds = min(timeit.repeat(lambda: fn(res), number=repeat, repeat=3)) / repeat
+            rows.append({'topics': n_topics, 'stage': name, 'candidates': len(fn(res)), 'us_per_call': round(seconds * 1e6, 1)})
+    return rows
+
+
+if __name__ == '__main__':
+    print(pd.DataFrame(run()).to_string(index=False))
@@ -0,0 +1,161 @@
+import json
+import re
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def _numbered_lines(text: str) -> list:
+    """Parses the "<ID>. <title>" candidate lines of a prompt into (ID, title) pairs"""
+    pairs = []
+    for line in text.splitlines():
+        id, _, title = line.partition('. ')
+        if id.isdigit():
+            pairs.append((int(id), title))
+    return pairs
+
+
+def stub_answer(prompt: str) -> dict:
+    """Answers the prompts built by RecommendationTemplateConstructor with well-formed JSON, without any model"""
+    if "Here are the potential articles" in prompt:
+        match = re.search(r"after its ID:\n(.*?)\nCan you provide", prompt, re.S)
+        candidates = _numbered_lines(match.group(1)) if match else []
+        candidates = candidates[:10]
+        return {"ids": [id for id, _ in candidates], "explanations": [f"Stub explanation for {title}" for _, title in candidates]}
+    if "These articles were selected for the user" in prompt:
+        match = re.search(r"after its ID:\n(.*?)\nFor every article", prompt, re.S)
+        titles = _numbered_lines(match.group(1)) if match else []
+        return {"explanations": [f"Stub explanation for {title}" for _, title in titles]}
+    if "Users request to adjust preferences" in prompt:
+        return {"preferences": "Interested in stub topics.", "response": "Your preferences have been updated successfully."}
+    return {"topics_of_interest": ["World news", "Technology", "Science"]}
+
+
+class _BurstHTTPServer(ThreadingHTTPServer):
+    # a deep listen backlog, bursts of concurrent clients must not be refused
+    request_queue_size = 1024
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # clients that timed out or were cancelled hang up before the answer, nothing to report
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+class StubLLMServer:
+    """OpenAI-compatible /v1/chat/completions endpoint on a free local port, answering after a fixed latency.
+    Streamed requests (stream=true) get the answer as server-sent chunks of a few characters, spread over the latency
+    like tokens being generated.
+
+    Args:
+        latency (float, optional): seconds to wait before answering each request. Defaults to 0.2.
+        answer (callable, optional): maps the prompt to the JSON answer. Defaults to stub_answer.
+        time_to_first_token (float, optional): part of the latency before the first streamed chunk. Defaults to 0.
+        chunk_chars (int, optional): characters per streamed chunk, about one token. Defaults to 4.
+
+    Usage:
+        with StubLLMServer(latency=0.5) as server:
+            LLMClient(base_url=server.base_url, api_key="stub")
+    """
+    def __init__(self, latency=0.2, answer=stub_answer, time_to_first_token=0.0, chunk_chars=4) -> None:
+        self.latency = latency
+        self.answer = answer
+        self.time_to_first_token = time_to_first_token
+        self.chunk_chars = chunk_chars
+        self.requests_served = 0
+        self.max_in_flight = 0
+        self._in_flight = 0
+        self._counter_lock = threading.Lock()
+        self._server = _BurstHTTPServer(('127.0.0.1', 0), self._make_handler())
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}/v1'
+
+    def _make_handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                raw_body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                if not raw_body:
+                    # the client hung up before sending the request body
+                    self.close_connection = True
+                    return
+                body = json.loads(raw_body)
+                with stub._counter_lock:
+                    stub._in_flight += 1
+                    stub.max_in_flight = max(stub.max_in_flight, stub._in_flight)
+                if body.get('stream'):
+                    try:
+                        self._stream(body)
+                    finally:
+                        with stub._counter_lock:
+                            stub._in_flight -= 1
+                            stub.requests_served += 1
+                    return
+                try:
+                    time.sleep(stub.latency)
+                    prompt = body['messages'][-1]['content']
+                    content = json.dumps(stub.answer(prompt))
+                    payload = json.dumps({
+                        'id': 'chatcmpl-stub', 'object': 'chat.completion', 'created': int(time.time()), 'model': body.get('model', 'stub'),
+                        'choices': [{'index': 0, 'finish_reason': 'stop', 'message': {'role': 'assistant', 'content': content}}],
+                        'usage': {'prompt_tokens': len(prompt) // 4, 'completion_tokens': len(content) // 4,
+                                  'total_tokens': len(prompt) // 4 + len(content) // 4},
+                    }).encode('utf-8')
+                finally:
+                    with stub._counter_lock:
+                        stub._in_flight -= 1
+                        stub.requests_served += 1
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def _write_chunk(self, data: bytes) -> None:
+                self.wfile.write(f'{len(data):x}\r\n'.encode('ascii') + data + b'\r\n')
+                self.wfile.flush()
+
+            def _stream(self, body: dict) -> None:
+                content = json.dumps(stub.answer(body['messages'][-1]['content']))
+                pieces = [content[start:start + stub.chunk_chars] for start in range(0, len(content), stub.chunk_chars)]
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/event-stream')
+                self.send_header('Transfer-Encoding', 'chunked')
+                self.end_headers()
+                time.sleep(stub.time_to_first_token)
+                piece_latency = max(stub.latency - stub.time_to_first_token, 0.0) / max(len(pieces), 1)
+                for index, piece in enumerate(pieces):
+                    event = {'id': 'chatcmpl-stub', 'object': 'chat.completion.chunk', 'created': int(time.time()),
+                             'model': body.get('model', 'stub'),
+                             'choices': [{'index': 0, 'delta': {'content': piece},
+                                          'finish_reason': 'stop' if index == len(pieces) - 1 else None}]}
+                    self._write_chunk(f'data: {json.dumps(event)}\n\n'.encode('utf-8'))
+                    time.sleep(piece_latency)
+                self._write_chunk(b'data: [DONE]\n\n')
+                self._write_chunk(b'')
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def start(self) -> 'StubLLMServer':
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
@@ -26,19 +26,40 @@
 # news_vector_storage = NewsVectorStorage(news_dataframe=news_df)
 # news_vector_storage.load_news()
 
+import asyncio
+import json
+import logging
+import os
+from contextlib import asynccontextmanager
+
 from fastapi import FastAPI
 
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import PlainTextResponse, StreamingResponse
 
-from LLM_interactions.GPTRecommender import GPTRecommender
-from LLM_interactions.RecommendationTemplateConstructor import RecommendationTemplateConstructor
-from RSS_feed_collector.NewsRetriever import NewsRetriever
-from vector_database.NewsVectorStorage import NewsVectorStorage
+from app_requests.AppResources import AppResources
 from app_requests.UserClick import UserClick
 from app_requests.AppInformationHandler import AppInformationHandler
+from app_requests.BatchRecommendationRequest import BatchRecommendationRequest
+from app_requests.Metrics import METRICS
+from app_requests.MetricsMiddleware import MetricsMiddleware
 from app_requests.UserAdjustment import UserAdjustment
 
-app = FastAPI()
+logger = logging.getLogger(__name__)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # one set of clients, templates and logging for the whole process, requests only borrow them
+    app.state.resources = AppResources(last_days_interaction=7, ranking_mode=os.environ.get("RANKING_MODE", "gpt"))
+    # news are refreshed in the background, recommendation requests never wait for ingestion
+    app.state.resources.ingestion_scheduler.start()
+    yield
+    await app.state.resources.ingestion_scheduler.stop()
+    await app.state.resources.close()
+
+app = FastAPI(lifespan=lifespan)
+# SERVER_TIMING=1 adds a per-stage Server-Timing header to every response
+app.add_middleware(MetricsMiddleware, server_timing=os.environ.get("SERVER_TIMING", "0") == "1")
 
 # create a hello return in the root
 @app.get("/")
@@ -46,43 +67,78 @@ def read_root():
     return {"Hello": "World"}
 
 @app.get("/load_new_news")
-def load_new_news():
-    news_vector_storage = NewsVectorStorage()
-
-    if news_vector_storage.are_news_outdated():
-        with open("RSS_feed_collector/rss_feeds.txt", "r") as file:
-            feeds_urls = [url.strip() for url in file.readlines()]
-        
-        # Retrieve news from RSS feeds using the list of URLs
-        news_retriever = NewsRetriever(feeds_urls)
-        news_df = news_retriever.retrieve_news()
-
-        # Load the news into the vector storage and update the timestamp
-        news_vector_storage.load_news(news_dataframe=news_df)
-        return {"status": "success"}
-    return {"status": "already updated"}
+def load_new_news(request: Request):
+    return request.app.state.resources.ingestion_scheduler.run_once()
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def metrics():
+    # Prometheus text exposition format
+    return PlainTextResponse(METRICS.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/ingestion_status")
+def ingestion_status(request: Request):
+    return request.app.state.resources.ingestion_scheduler.status()
 
 @app.get("/get_recommendations/{user_id}")
-def get_recommendations(user_id: str):
-    load_new_news() # for now I handle news updates like this
-    template_constructor = RecommendationTemplateConstructor(last_days_interaction=7)
-    recommender = GPTRecommender(template_constructor=template_constructor)
-    return recommender.get_recommendations(user_id=user_id)
+async def get_recommendations(user_id: str, request: Request):
+    # served from the per-user store, recomputed in the background when the inputs changed
+    return await request.app.state.resources.recommendation_store.get(user_id)
+
+@app.get("/stream_recommendations/{user_id}")
+async def stream_recommendations(user_id: str, request: Request):
+    # one article per event, as soon as GPT wrote it: server-sent events when asked for, NDJSON otherwise
+    articles = request.app.state.resources.stream_recommendations(user_id)
+    if "text/event-stream" in request.headers.get("accept", ""):
+        async def events():
+            try:
+                async for article in articles:
+                    yield f"event: article\ndata: {json.dumps(article)}\n\n"
+            except Exception as e:
+                # the 200 headers are out already, the failure can only be reported in the stream
+                logger.error(f"Streaming recommendations of user {user_id} failed: {e!r}")
+                yield f"event: error\ndata: {json.dumps({'error': str(e)})}\n\n"
+                return
+            yield "event: done\ndata: {}\n\n"
+        return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+    async def lines():
+        try:
+            async for article in articles:
+                yield json.dumps(article) + "\n"
+        except Exception as e:
+            logger.error(f"Streaming recommendations of user {user_id} failed: {e!r}")
+            yield json.dumps({"error": str(e)}) + "\n"
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+@app.post("/get_recommendations_batch/")
+async def get_recommendations_batch(batch_request: BatchRecommendationRequest, request: Request):
+    # one JSON line per user (NDJSON), streamed in the order the users complete
+    batch_recommender = request.app.state.resources.batch_recommender()
+
+    async def lines():
+        async for result in batch_recommender.stream(batch_request.user_ids, force=batch_request.force):
+            yield json.dumps(result) + "\n"
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
 
 # here I want to enable the app to send the data about what articles the user clicked on
 
 # user id is inside the UserClick object
 @app.post("/submit_user_click/")
-async def submit_name_date(user_click: UserClick):
+async def submit_name_date(user_click: UserClick, request: Request):
     print(f"Received a user click. Name: {user_click.user_id}, Date: {user_click.title}, Date: {user_click.date}, Domain: {user_click.domain}")
     try:
-        AppInformationHandler.save_user_click(user_click)
+        await asyncio.to_thread(AppInformationHandler.save_user_click, user_click, request.app.state.resources.interaction_store)
+        # the click changes the history the topics were derived from
+        request.app.state.resources.topic_cache.invalidate(user_click.user_id)
+        request.app.state.resources.recommendation_store.schedule_refresh(user_click.user_id)
         return {"status": "success"}
     except Exception as e:
         return {"status": "error", "message": str(e)}
     
 @app.post("/adjust_recommendations/")
-async def adjust_recommendations(user_adjustment: UserAdjustment):
-    template_constructor = RecommendationTemplateConstructor(last_days_interaction=7)
-    recommender = GPTRecommender(template_constructor=template_constructor)
-    return {"response": recommender.adjust_recommendations(user_id=user_adjustment.user_id, request=user_adjustment.request)["response"]}
\ No newline at end of file
+async def adjust_recommendations(user_adjustment: UserAdjustment, request: Request):
+    recommender = request.app.state.resources.recommender()
+    adjusted_recommendation = await recommender.adjust_recommendations(user_id=user_adjustment.user_id, request=user_adjustment.request)
+    if adjusted_recommendation["preferences"] is not None:
+        request.app.state.resources.recommendation_store.schedule_refresh(user_adjustment.user_id)
+    return {"response": adjusted_recommendation["response"]}
\ No newline at end of file
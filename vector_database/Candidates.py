@@ -0,0 +1,88 @@
+import json
+
+
+class Candidates:
+    """Articles on their way from the vector database to the response: the retrieved candidates, the recommended
+    ones and the random diversification articles alike.
+
+    Stored column-wise, one plain list per response field, which is the shape of the response JSON already.
+    The operations of a request (picking rows, dropping duplicates, appending the random articles) are single
+    passes over a few dozen rows, without the index, dtype and block machinery of a DataFrame.
+    A row's position is its 0-based index, candidate IDs in the prompts are positions + 1.
+    """
+    COLUMNS = ('distance', 'link', 'domain', 'published', 'title', 'summary', 'alternate_sources', 'explanations')
+    __slots__ = COLUMNS
+
+    def __init__(self, columns=None) -> None:
+        columns = columns or {}
+        length = len(next(iter(columns.values()), ()))
+        for column in self.COLUMNS:
+            setattr(self, column, columns[column] if column in columns else [None] * length)
+
+    @classmethod
+    def from_metadatas(cls, metadatas: list, distances=None) -> 'Candidates':
+        """Builds the candidates from stored Chroma metadatas, bookkeeping fields like content_hash are left out.
+
+        Args:
+            metadatas (list): one metadata dict per article
+            distances (list, optional): distance of every article to the query. 0 for all when None (random articles).
+        """
+        columns = {column: [meta.get(column) for meta in metadatas] for column in ('link', 'domain', 'published', 'title', 'summary')}
+        columns['distance'] = [float(distance) for distance in distances] if distances is not None else [0.0] * len(metadatas)
+        # stored as JSON, metadata values must be scalars. Articles stored before clustering have none
+        columns['alternate_sources'] = [[{key: source[key] for key in ('link', 'domain', 'title')} for source in json.loads(value)]
+                                        if isinstance(value, str) else [] for value in (meta.get('alternate_sources') for meta in metadatas)]
+        return cls(columns)
+
+    def __len__(self) -> int:
+        return len(self.link)
+
+    def __repr__(self) -> str:
+        return f"Candidates({len(self)} articles: {self.title!r})"
+
+    def take(self, positions) -> 'Candidates':
+        """The rows at the given positions, in that order"""
+        return Candidates({column: [values[position] for position in positions]
+                           for column, values in zip(self.COLUMNS, self._columns())})
+
+    def head(self, k: int) -> 'Candidates':
+        """The first k rows, i.e. the top k of candidates ordered best first"""
+        return Candidates({column: values[:k] for column, values in zip(self.COLUMNS, self._columns())})
+
+    def dedupe(self, column='title') -> 'Candidates':
+        """Keeps the first row of every value of column"""
+        seen, positions = set(), []
+        for position, value in enumerate(getattr(self, column)):
+            if value not in seen:
+                seen.add(value)
+                positions.append(position)
+        return self if len(positions) == len(self) else self.take(positions)
+
+    def concat(self, other: 'Candidates') -> 'Candidates':
+        """These rows followed by the rows of other"""
+        return Candidates({column: values + other_values
+                           for column, values, other_values in zip(self.COLUMNS, self._columns(), other._columns())})
+
+    def with_explanations(self, explanations) -> 'Candidates':
+        """The same rows with their explanations set, one per row or a single text for all"""
+        explanations = [explanations] * len(self) if isinstance(explanations, str) else list(explanations)
+        if len(explanations) != len(self):
+            raise ValueError(f"{len(explanations)} explanations for {len(self)} articles")
+        columns = dict(zip(self.COLUMNS, self._columns()))
+        columns['explanations'] = explanations
+        return Candidates(columns)
+
+    def row(self, position: int) -> dict:
+        """One article as a dict, with the same fields as a column of the response JSON"""
+        return {column: values[position] for column, values in zip(self.COLUMNS, self._columns())}
+
+    def rows(self):
+        for position in range(len(self)):
+            yield self.row(position)
+
+    def to_payload(self) -> dict:
+        """The response JSON: {field: [value of every article]}"""
+        return {column: list(values) for column, values in zip(self.COLUMNS, self._columns())}
+
+    def _columns(self) -> tuple:
+        return tuple(getattr(self, column) for column in self.COLUMNS)
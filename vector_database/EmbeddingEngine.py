@@ -0,0 +1,152 @@
+import hashlib
+import logging
+import multiprocessing
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from chromadb.utils import embedding_functions
+
+from app_requests.Metrics import METRICS
+
+logger = logging.getLogger(__name__)
+
+# embedding function of a pool worker process, built once per process by _init_worker
+_worker_embedding_function = None
+
+
+def _init_worker(embedding_function_factory) -> None:
+    global _worker_embedding_function
+    _worker_embedding_function = embedding_function_factory()
+
+
+def _embed_in_worker(texts: list) -> np.ndarray:
+    return np.asarray(_worker_embedding_function(texts), dtype=np.float32)
+
+
+class EmbeddingEngine:
+    """Embeds texts in batches, in a pool of processes for large inputs, with a persistent cache keyed by text hash.
+
+    Identical texts (unchanged articles, recurring topics like "US Presidential Elections", clicked titles) are
+    embedded once and then read back from SQLite. Misses are deduplicated and embedded in batches; inputs of at
+    least min_parallel_texts misses are spread over n_workers processes, each loading its own copy of the model.
+    Small inputs, like the topics of one query, stay in the calling process where there is no IPC to pay for.
+
+    Also usable as a Chroma embedding function, so anything Chroma embeds itself goes through the cache too.
+
+    Args:
+        embedding_function_factory (callable, optional): builds the embedding function, texts -> vectors. Must be
+            picklable (a module-level function or class) to run in the pool. Defaults to Chroma's default model.
+        model_name (str, optional): part of the cache key, change it when the model changes. Defaults to "all-MiniLM-L6-v2".
+        cache_path (str, optional): SQLite file of the cache. None keeps the cache in memory only.
+        n_workers (int, optional): processes of the pool, 1 disables it. Defaults to the number of CPU cores.
+        batch_size (int, optional): texts per model call. Defaults to 64.
+        min_parallel_texts (int, optional): fewest misses worth sending to the pool. Defaults to 256.
+        max_unused_days (float, optional): prune drops cache entries not used for this long. Defaults to 7.
+    """
+    def __init__(self, embedding_function_factory=embedding_functions.DefaultEmbeddingFunction, model_name="all-MiniLM-L6-v2",
+                 cache_path=None, n_workers=None, batch_size=64, min_parallel_texts=256, max_unused_days=7) -> None:
+        self._embedding_function_factory = embedding_function_factory
+        self._embedding_function = None
+        self._model_name = model_name
+        self._n_workers = n_workers if n_workers is not None else (os.cpu_count() or 1)
+        self._batch_size = batch_size
+        self._min_parallel_texts = min_parallel_texts
+        self._max_unused_days = max_unused_days
+        self._pool = None
+        self._lock = threading.Lock()
+        # shared by every worker and the ingest thread: WAL lets reads go on during an ingest's writes
+        self._cache = sqlite3.connect(cache_path if cache_path is not None else ':memory:', timeout=30, check_same_thread=False)
+        self._cache.execute("PRAGMA journal_mode=WAL")
+        self._cache.execute("PRAGMA synchronous=NORMAL")
+        self._cache.execute("CREATE TABLE IF NOT EXISTS embeddings (text_hash TEXT PRIMARY KEY, vector BLOB NOT NULL, last_used REAL NOT NULL)")
+        self._cache.commit()
+
+    def _text_hash(self, text: str) -> str:
+        return hashlib.sha1(f"{self._model_name}\0{text}".encode('utf-8')).hexdigest()
+
+    def _read_cache(self, text_hashes: list) -> dict:
+        """Returns {text_hash: vector} of the cached hashes, refreshing last_used of the entries not touched for an hour"""
+        now = time.time()
+        cached, stale = {}, []
+        with self._lock:
+            # stay below sqlite's limit of bound parameters
+            for start in range(0, len(text_hashes), 500):
+                chunk = text_hashes[start:start + 500]
+                rows = self._cache.execute(f"SELECT text_hash, vector, last_used FROM embeddings WHERE text_hash IN ({','.join('?' * len(chunk))})",
+                                           chunk).fetchall()
+                for text_hash, vector, last_used in rows:
+                    cached[text_hash] = np.frombuffer(vector, dtype=np.float32)
+                    if now - last_used > 60 * 60:
+                        stale.append((now, text_hash))
+            if stale:
+                self._cache.executemany("UPDATE embeddings SET last_used = ? WHERE text_hash = ?", stale)
+                self._cache.commit()
+        return cached
+
+    def _write_cache(self, text_hashes: list, vectors: np.ndarray) -> None:
+        now = time.time()
+        with self._lock:
+            self._cache.executemany("INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?)",
+                                    [(text_hash, vector.tobytes(), now) for text_hash, vector in zip(text_hashes, vectors)])
+            self._cache.commit()
+
+    def _get_pool(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            # spawn, forking a process that already runs onnxruntime and sqlite threads is not safe
+            self._pool = ProcessPoolExecutor(max_workers=self._n_workers, mp_context=multiprocessing.get_context('spawn'),
+                                             initializer=_init_worker, initargs=(self._embedding_function_factory,))
+        return self._pool
+
+    def _compute(self, texts: list) -> np.ndarray:
+        batches = [texts[start:start + self._batch_size] for start in range(0, len(texts), self._batch_size)]
+        with METRICS.span('embed_model'):
+            if self._n_workers > 1 and len(texts) >= self._min_parallel_texts:
+                return np.concatenate(list(self._get_pool().map(_embed_in_worker, batches)))
+            if self._embedding_function is None:
+                self._embedding_function = self._embedding_function_factory()
+            return np.concatenate([np.asarray(self._embedding_function(batch), dtype=np.float32) for batch in batches])
+
+    def embed(self, texts: list) -> np.ndarray:
+        """Returns one embedding per text, in order, computing only those that are not cached yet"""
+        if not texts:
+            return np.zeros((0, 0), dtype=np.float32)
+        text_hashes = [self._text_hash(text) for text in texts]
+        vectors = self._read_cache(list(dict.fromkeys(text_hashes)))
+        # each distinct missing text is embedded once, however often it occurs
+        missing = {text_hash: text for text_hash, text in zip(text_hashes, texts) if text_hash not in vectors}
+        METRICS.inc('embedding_cache_hits_total', len(texts) - sum(text_hash in missing for text_hash in text_hashes))
+        METRICS.inc('embedding_cache_misses_total', len(missing))
+        if missing:
+            computed = self._compute(list(missing.values()))
+            self._write_cache(list(missing), computed)
+            vectors.update(zip(missing, computed))
+        return np.stack([vectors[text_hash] for text_hash in text_hashes])
+
+    def __call__(self, input: list) -> list:
+        # Chroma's embedding function interface
+        return self.embed(list(input)).tolist()
+
+    def prune(self) -> int:
+        """Drops the cache entries not used for max_unused_days, e.g. those of expired articles
+
+        Returns:
+            int: number of dropped entries
+        """
+        cutoff = time.time() - self._max_unused_days * 24 * 60 * 60
+        with self._lock:
+            pruned = self._cache.execute("DELETE FROM embeddings WHERE last_used < ?", (cutoff,)).rowcount
+            self._cache.commit()
+        if pruned:
+            logger.info(f"Pruned {pruned} unused embeddings from the cache")
+        return pruned
+
+    def close(self) -> None:
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+        with self._lock:
+            self._cache.close()
@@ -0,0 +1,125 @@
+import asyncio
+import fcntl
+import json
+import logging
+import os
+import time
+
+from RSS_feed_collector.NewsRetriever import NewsRetriever
+from vector_database.NewsVectorStorage import NewsVectorStorage
+
+logger = logging.getLogger(__name__)
+
+
+class IngestionScheduler:
+    """Refreshes the news collection in the background, off the recommendation request path.
+
+    Ingestion is single-flight across processes: a run holds an exclusive lock on lock_path, so when several
+    uvicorn workers wake up at once only one of them crawls and embeds, the others skip. The outcome of the
+    last run is kept in status_path so every worker reports the same status.
+
+    Args:
+        feeds_path (str, optional): file with one RSS feed URL per line. Defaults to 'RSS_feed_collector/rss_feeds.txt'.
+        check_interval (float, optional): seconds between freshness checks. Defaults to 600.
+        lock_path (str, optional): lock file shared by all workers. Defaults to 'vector_database/ingest.lock'.
+        status_path (str, optional): JSON file with the status of the last run. Defaults to 'vector_database/ingest_status.json'.
+        news_vector_storage (NewsVectorStorage, optional): shared vector storage. A new one is created per run when None.
+        on_ingested (callable, optional): called with the load counts after every successful run, from the ingesting thread.
+    """
+    def __init__(self, feeds_path='RSS_feed_collector/rss_feeds.txt', check_interval=600.0,
+                 lock_path='vector_database/ingest.lock', status_path='vector_database/ingest_status.json',
+                 news_vector_storage=None, on_ingested=None) -> None:
+        self._news_vector_storage = news_vector_storage
+        self._on_ingested = on_ingested
+        self._feeds_path = feeds_path
+        self._check_interval = check_interval
+        self._lock_path = lock_path
+        self._status_path = status_path
+        self._task = None
+
+    def _read_feeds(self) -> list:
+        with open(self._feeds_path, 'r') as file:
+            return [url.strip() for url in file.readlines() if url.strip()]
+
+    def _write_status(self, status: dict) -> None:
+        tmp_path = self._status_path + '.tmp'
+        with open(tmp_path, 'w') as file:
+            json.dump(status, file)
+        os.replace(tmp_path, self._status_path)
+
+    def _read_status(self) -> dict:
+        try:
+            with open(self._status_path, 'r') as file:
+                return json.load(file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {"state": "never run"}
+
+    def run_once(self, force=False) -> dict:
+        """Ingests fresh news if they are outdated (or force is set) and no other process is ingesting already.
+
+        Returns:
+            dict: the status of this attempt
+        """
+        with open(self._lock_path, 'a') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return {"status": "in progress"}
+            try:
+                return self._ingest(force)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _ingest(self, force: bool) -> dict:
+        news_vector_storage = self._news_vector_storage or NewsVectorStorage()
+        # checked again under the lock, another worker may have just finished a run
+        if not force and not news_vector_storage.are_news_outdated():
+            return {"status": "already updated"}
+
+        started = time.time()
+        self._write_status({**self._read_status(), "state": "running", "started": started})
+        try:
+            # Retrieve news from RSS feeds using the list of URLs
+            news_retriever = NewsRetriever(self._read_feeds())
+            news_df = news_retriever.retrieve_news()
+
+            # Load the news into the vector storage and update the timestamp
+            load_counts = news_vector_storage.load_news(news_dataframe=news_df)
+            # only now remember the feed validators, so a failed load is retried in full next time
+            news_retriever.save_feed_state()
+        except Exception as e:
+            logger.exception("News ingestion failed")
+            self._write_status({"state": "failed", "started": started, "finished": time.time(), "error": str(e)})
+            return {"status": "error", "message": str(e)}
+        self._write_status({"state": "idle", "started": started, "finished": time.time(), "result": load_counts})
+        if self._on_ingested is not None:
+            self._on_ingested(load_counts)
+        return {"status": "success", **load_counts}
+
+    def status(self) -> dict:
+        status = self._read_status()
+        status["last_updated_time"] = NewsVectorStorage.read_last_updated_time()
+        return status
+
+    async def _run_forever(self) -> None:
+        while True:
+            try:
+                result = await asyncio.to_thread(self.run_once)
+                logger.info(f"Scheduled news ingestion: {result}")
+            except Exception:
+                logger.exception("Scheduled news ingestion crashed")
+            await asyncio.sleep(self._check_interval)
+
+    def start(self) -> None:
+        """Starts the periodic ingestion on the running event loop"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run_forever())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
@@ -1,141 +1,530 @@
 import chromadb
-import pandas as pd
 import time
-from datetime import datetime, timedelta
-import random
+from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
+import logging
+import os
+import hashlib
+import json
+import math
+import numpy as np
+from app_requests.Metrics import METRICS
+from vector_database.Candidates import Candidates
+from vector_database.EmbeddingEngine import EmbeddingEngine
+from vector_database.RandomIdIndex import RandomIdIndex
+from vector_database.StoryClusterer import StoryClusterer
+
+logger = logging.getLogger(__name__)
+
 
 class NewsVectorStorage:
-    def __init__(self) -> None:
+    """Stores news articles as embeddings in a persistent Chroma collection.
+
+    Args:
+        batch_size (int, optional): maximum number of articles embedded and upserted at once. Defaults to 256.
+        max_batch_chars (int, optional): memory ceiling of a batch, as the total length of its documents. Defaults to 1_000_000.
+        retention_days (float, optional): articles published longer ago than this are expired on load. Defaults to 3.
+        min_results_per_topic (int, optional): lower bound of the adaptive per-topic k of query_topics. Defaults to 3.
+        embedding_engine (EmbeddingEngine, optional): computes and caches every embedding, articles and query topics alike.
+            Defaults to Chroma's default model with the cache in 'vector_database/embeddings.sqlite3'.
+        story_clusterer (StoryClusterer, optional): decides which articles are the same story, on load and in query
+            results. Defaults to StoryClusterer() (cosine similarity of at least 0.9).
+    """
+    def __init__(self, batch_size=256, max_batch_chars=1_000_000, retention_days=3, min_results_per_topic=3,
+                 embedding_engine=None, story_clusterer=None) -> None:
+        self._min_results_per_topic = min_results_per_topic
         self._collection_name = "rss_news"
+        self._retention_days = retention_days
+        self._batch_size = batch_size
+        self._max_batch_chars = max_batch_chars
         self._news_vector_db_client = None
         self._collection = None
+        self._random_id_index = None
+        self._random_id_index_version = None
+        self._alias_index = None
+        self._alias_index_version = None
+        # embeddings are computed here and handed to chroma, the collection only falls back to the engine
+        self._embedding_engine = embedding_engine if embedding_engine is not None else \
+            EmbeddingEngine(cache_path='vector_database/embeddings.sqlite3')
+        self._story_clusterer = story_clusterer if story_clusterer is not None else StoryClusterer()
         self._prepare_db_client_and_collection()
 
     def _prepare_db_client_and_collection(self):
         self._news_vector_db_client = chromadb.PersistentClient(path="storage")
         try:
             self._collection = self._news_vector_db_client.get_collection(
-                name=self._collection_name)
+                name=self._collection_name, embedding_function=self._embedding_engine)
         except Exception:
             self._collection = self._news_vector_db_client.create_collection(
-                name=self._collection_name)
+                name=self._collection_name, embedding_function=self._embedding_engine)
+
+    def embed(self, texts: list) -> np.ndarray:
+        """Embeds texts with the model of the collection, so they are comparable with the stored articles.
+        Texts embedded before are read from the engine's cache."""
+        if not texts:
+            return np.zeros((0, 0), dtype=np.float32)
+        with METRICS.span('embed'):
+            return self._embedding_engine.embed(texts)
+
+    def get_embeddings(self, ids: list) -> np.ndarray:
+        """Returns the stored embeddings of the given ids in the same order, zeros for ids that are no longer stored"""
+        if not ids:
+            stored = {'ids': [], 'embeddings': []}
+        else:
+            with METRICS.span('vector_get_embeddings'):
+                stored = self._collection.get(ids=ids, include=['embeddings'])
+        positions = {id: position for position, id in enumerate(stored['ids'])}
+        if not positions:
+            return np.zeros((len(ids), 0), dtype=np.float32)
+        dimension = len(stored['embeddings'][0])
+        return np.asarray([stored['embeddings'][positions[id]] if id in positions else np.zeros(dimension)
+                           for id in ids], dtype=np.float32)
     
+    @staticmethod
+    def published_timestamp(published_date) -> float:
+        """Normalizes a feed publication date (RFC-822 with any zone, or ISO 8601) to unix time.
+        Unparseable dates are treated as published now, so they still expire after the retention window."""
+        try:
+            published_datetime = parsedate_to_datetime(published_date)
+        except (TypeError, ValueError):
+            try:
+                published_datetime = datetime.fromisoformat(published_date)
+            except (TypeError, ValueError):
+                return time.time()
+        if published_datetime.tzinfo is None:
+            published_datetime = published_datetime.replace(tzinfo=timezone.utc)
+        return published_datetime.timestamp()
+
     @staticmethod
     def older_than_n_days(published_date, n_days=3):
-            date_format = "%a, %d %b %Y %H:%M:%S"
-            trimmed_published_date = published_date[:-6]
-            published_datetime = datetime.strptime(trimmed_published_date, date_format)
-            return datetime.now() - published_datetime > timedelta(days=n_days)
-        
-    def load_news(self, news_dataframe):
-        # first delete all the news that are older than 3 days
-        old_to_delete = self._collection.get()
-        old_news_ids = [old_to_delete['ids'][index] for index, meta in enumerate(old_to_delete['metadatas']) if self.older_than_n_days(meta['published'])]
-        print("All news #: ", len(old_to_delete['ids']))
-        print("To be deleted: ", len(old_news_ids))
-        if old_news_ids:
-            self._collection.delete(ids=old_news_ids)
+        return time.time() - NewsVectorStorage.published_timestamp(published_date) > timedelta(days=n_days).total_seconds()
+
+    def _backfill_published_timestamps(self):
+        """One-time migration for collections stored before published_ts existed, otherwise their articles would never expire"""
+        collection_metadata = self._collection.metadata or {}
+        if collection_metadata.get('published_ts_backfilled'):
+            return
+        stored = self._collection.get(include=['metadatas'])
+        missing = [(id, meta) for id, meta in zip(stored['ids'], stored['metadatas']) if 'published_ts' not in meta]
+        for start in range(0, len(missing), self._batch_size):
+            batch = missing[start:start + self._batch_size]
+            self._collection.update(ids=[id for id, _ in batch],
+                                    metadatas=[{**meta, 'published_ts': self.published_timestamp(meta['published'])} for _, meta in batch])
+        logger.info(f"Backfilled published_ts of {len(missing)} articles")
+        self._collection.modify(metadata={**collection_metadata, 'published_ts_backfilled': True})
+
+    def _expire_old_news(self) -> int:
+        """Deletes the articles older than the retention window with a single range delete on published_ts.
+        Nothing is loaded into Python, so the cost follows the number of expired rows rather than the collection size.
+
+        Returns:
+            int: number of expired articles
+        """
+        self._backfill_published_timestamps()
+        cutoff = time.time() - timedelta(days=self._retention_days).total_seconds()
+        with METRICS.span('expire'):
+            count_before = self._collection.count()
+            self._collection.delete(where={'published_ts': {'$lt': cutoff}})
+            expired = count_before - self._collection.count()
+        METRICS.inc('expired_articles_total', expired)
+        logger.info(f"Expired {expired} articles older than {self._retention_days} days")
+        return expired
+
+    @staticmethod
+    def content_hash(document: str) -> str:
+        return hashlib.sha1(document.encode('utf-8')).hexdigest()
+
+    def _get_stored_metadatas(self, ids: list) -> dict:
+        """Returns {id: metadata} for those of the given ids that are already stored, without loading documents or embeddings"""
+        stored_metadatas = {}
+        for start in range(0, len(ids), self._batch_size):
+            with METRICS.span('vector_get_content_hashes'):
+                stored = self._collection.get(ids=ids[start:start + self._batch_size], include=['metadatas'])
+            stored_metadatas.update(zip(stored['ids'], stored['metadatas']))
+        return stored_metadatas
+
+    def _nearest_stored(self, embeddings: np.ndarray, exclude: set) -> dict:
+        """Finds the stored article closest to every embedding, skipping the ids in exclude.
+
+        Returns:
+            dict: {row of embeddings: (id, metadata)} for the rows whose closest article is the same story
+        """
+        n_stored = self._collection.count()
+        if n_stored == 0 or len(embeddings) == 0:
+            return {}
+        normalized = StoryClusterer.normalize(embeddings)
+        nearest = {}
+        for start in range(0, len(embeddings), self._batch_size):
+            with METRICS.span('vector_query_duplicates'):
+                # one extra neighbour, the closest one may be the article itself when its text changed
+                results = self._collection.query(query_embeddings=embeddings[start:start + self._batch_size].tolist(),
+                                                 n_results=min(2, n_stored), include=['metadatas', 'embeddings'])
+            for row, neighbours in enumerate(zip(results['ids'], results['metadatas'], results['embeddings']), start):
+                for id, meta, embedding in zip(*neighbours):
+                    if id in exclude:
+                        continue
+                    if StoryClusterer.normalize([embedding])[0] @ normalized[row] >= self._story_clusterer.threshold:
+                        nearest[row] = (id, meta)
+                    break
+        return nearest
+
+    def _fold_near_duplicates(self, ids: list, metadatas: list, embeddings: np.ndarray) -> dict:
+        """Clusters the incoming articles with each other and with their closest stored articles, and keeps one
+        canonical article per story: a stored one when there is one, so links already served stay valid, otherwise
+        the earliest published. The other members are recorded in its alternate_sources metadata instead of being stored.
+
+        Args:
+            ids, metadatas, embeddings: the incoming new or changed articles. Canonical metadatas are updated in place.
+
+        Returns:
+            dict: 'keep' (positions of the incoming articles to store), 'stored_updates' ({id: metadata} of stored
+                articles that gained sources) and 'stored_folded' (ids of stored articles folded into another one)
+        """
+        pairs = self._story_clusterer.similar_pairs(embeddings).tolist()
+        stored = {}
+        for row, (id, meta) in self._nearest_stored(embeddings, exclude=set(ids)).items():
+            pairs.append((row, id))
+            stored[id] = meta
+        keep, stored_updates, stored_folded = set(range(len(ids))), {}, []
+        # incoming articles are keyed by position, stored ones by id
+        for cluster in self._story_clusterer.group(list(range(len(ids))) + list(stored), pairs):
+            members = [(key, metadatas[key] if isinstance(key, int) else stored[key]) for key in cluster]
+            stored_members = [member for member in members if not isinstance(member[0], int)]
+            canonical_key, canonical_meta = min(stored_members or members, key=lambda member: member[1]['published_ts'])
+            sources = {source['link']: source for source in json.loads(canonical_meta.get('alternate_sources', '[]'))}
+            for key, meta in members:
+                if key == canonical_key:
+                    continue
+                for source in json.loads(meta.get('alternate_sources', '[]')):
+                    sources.setdefault(source['link'], source)
+                sources.setdefault(meta['link'], {'link': meta['link'], 'domain': meta['domain'], 'title': meta['title'],
+                                                  'content_hash': meta.get('content_hash')})
+                if isinstance(key, int):
+                    keep.discard(key)
+                else:
+                    stored_folded.append(key)
+            sources.pop(canonical_meta['link'], None)
+            alternate_sources = json.dumps(list(sources.values()))
+            if isinstance(canonical_key, int):
+                canonical_meta['alternate_sources'] = alternate_sources
+            elif alternate_sources != canonical_meta.get('alternate_sources', '[]'):
+                stored_updates[canonical_key] = {**canonical_meta, 'alternate_sources': alternate_sources}
+        return {'keep': sorted(keep), 'stored_updates': stored_updates, 'stored_folded': stored_folded}
+
+    def _get_alias_index(self) -> dict:
+        """Returns {link of a folded duplicate: (id of its canonical article, its content hash)}, rebuilt only when
+        an ingest (possibly by another worker) committed since"""
+        last_updated_time = self.read_last_updated_time()
+        if self._alias_index is None or last_updated_time != self._alias_index_version:
+            stored = self._collection.get(include=['metadatas'])
+            self._alias_index = {}
+            self._add_aliases(stored['metadatas'])
+            self._alias_index_version = last_updated_time
+        return self._alias_index
+
+    def _add_aliases(self, canonical_metadatas) -> None:
+        for meta in canonical_metadatas:
+            for source in json.loads(meta.get('alternate_sources', '[]')):
+                self._alias_index[source['link']] = (meta['link'], source.get('content_hash'))
+
+    def load_news(self, news_dataframe) -> dict:
+        """Expires old articles, then embeds and stores only the articles that are new or whose title/summary changed.
+        The same story carried by several feeds is stored once, with the other sources in its alternate_sources.
+
+        Args:
+            news_dataframe (pd.DataFrame): news as returned by NewsRetriever.retrieve_news
+
+        Returns:
+            dict: counts of inserted, updated, unchanged, duplicate (folded into another article) and expired articles
+        """
+        # first delete all the news that are older than the retention window
+        expired = self._expire_old_news()
+        self._embedding_engine.prune()
         
         
         # get the list of textual data that we want to store in the vector database
         news_dataframe.drop_duplicates(subset=['link'], inplace=True)
-        documents = news_dataframe.apply(lambda row: str(row['title']) + ' ' + str(row['summary']), axis=1).tolist()
+        documents = (news_dataframe['title'].astype(str) + ' ' + news_dataframe['summary'].astype(str)).tolist()
         
         # get the dictionary of metadata that we want to store in the vector database
         # orient='records' instructs Pandas to represent each row in the DataFrame as a separate dictionary within a list
-        metadatas = metadatas=news_dataframe[['link', 'domain', 'published', 'title', 'summary']].to_dict(orient='records')
+        metadatas = news_dataframe[['link', 'domain', 'published', 'title', 'summary']].to_dict(orient='records')
         
         # we use link as the unique identifier for each document (article)
-        ids = news_dataframe.apply(lambda row: str(row['link']), axis=1).tolist()
-        # upsert each document and its metadata one by one to prevent memory issues on the server
-        for doc, meta, id in zip(documents, metadatas, ids):
-            print("upserting document with id: ", id)
-            self._collection.upsert(documents=[doc], metadatas=[meta], ids=[id])
-        self._write_last_updated_time()
+        ids = news_dataframe['link'].astype(str).tolist()
+
+        # diff the incoming batch against the stored content hashes, so only new or changed text gets embedded
+        alias_index = self._get_alias_index()
+        canonical_ids = [alias_index[id][0] for id in ids if id in alias_index]
+        stored_metadatas = self._get_stored_metadatas(list(dict.fromkeys(ids + canonical_ids)))
+        changed, known_duplicates = [], 0
+        for index, (doc, meta, id) in enumerate(zip(documents, metadatas, ids)):
+            meta['content_hash'] = self.content_hash(doc)
+            meta['published_ts'] = self.published_timestamp(meta['published'])
+            stored_meta = stored_metadatas.get(id, {})
+            # sources folded into this article before stay with it when its text changes
+            meta['alternate_sources'] = stored_meta.get('alternate_sources', '[]')
+            if stored_meta.get('content_hash') == meta['content_hash']:
+                continue
+            canonical_id, alias_hash = alias_index.get(id, (None, None))
+            if alias_hash == meta['content_hash'] and canonical_id in stored_metadatas:
+                # an unchanged duplicate already recorded with its canonical article
+                known_duplicates += 1
+                continue
+            changed.append(index)
+
+        embeddings = self.embed([documents[index] for index in changed])
+        folding = self._fold_near_duplicates([ids[index] for index in changed], [metadatas[index] for index in changed], embeddings)
+        stored_updates, stored_folded = folding['stored_updates'], folding['stored_folded']
+        to_store = [changed[position] for position in folding['keep']]
+        inserted = sum(ids[index] not in stored_metadatas for index in to_store)
+        counts = {"inserted": inserted,
+                  "updated": len(to_store) - inserted + len(stored_updates),
+                  "unchanged": len(ids) - len(changed) - known_duplicates,
+                  "duplicates": known_duplicates + len(changed) - len(to_store),
+                  "expired": expired}
+
+        self._upsert_in_batches([documents[index] for index in to_store],
+                                [metadatas[index] for index in to_store],
+                                [ids[index] for index in to_store],
+                                embeddings[folding['keep']] if to_store else None)
+        if stored_updates:
+            self._collection.update(ids=list(stored_updates), metadatas=list(stored_updates.values()))
+        if stored_folded:
+            self._collection.delete(ids=stored_folded)
+        METRICS.inc('duplicate_articles_total', len(changed) - len(to_store) + len(stored_folded))
+        last_updated_time = self._write_last_updated_time()
+        if to_store or stored_updates or stored_folded or expired:
+            self._write_timestamp('vector_database/news_version.txt')
+        self._refresh_random_id_index([ids[index] for index in to_store],
+                                      [metadatas[index]['published_ts'] for index in to_store],
+                                      last_updated_time, removed_ids=stored_folded)
+        self._add_aliases([metadatas[index] for index in to_store] + list(stored_updates.values()))
+        self._alias_index_version = last_updated_time
+        logger.info(f"Loaded news: {counts}")
+        return counts
     
-    def _write_last_updated_time(self):
-        with open('vector_database/last_updated_time.txt', 'w') as f:
-            f.write(str(time.time()))
-            
-    def _read_last_updated_time(self):
+    def _iter_batches(self, documents):
+        """Yields (start, end) slices of documents bounded both by the batch size and the memory ceiling"""
+        batch_size = min(self._batch_size, self._news_vector_db_client.max_batch_size)
+        start = 0
+        while start < len(documents):
+            end = start
+            batch_chars = 0
+            while end < len(documents) and end - start < batch_size:
+                batch_chars += len(documents[end])
+                # a single oversized document still goes through on its own
+                if batch_chars > self._max_batch_chars and end > start:
+                    break
+                end += 1
+            yield start, end
+            start = end
+
+    def _upsert_in_batches(self, documents, metadatas, ids, embeddings=None):
+        """Embeds and upserts the documents chunk by chunk, so one embedding call covers a whole batch
+        while memory stays bounded on the server. Embedding happens here rather than inside chroma, so both steps are timed apart
+        and texts embedded before come from the embedding cache. Embeddings computed by the caller are used as they are."""
+        total = len(documents)
+        for start, end in self._iter_batches(documents):
+            batch_embeddings = embeddings[start:end] if embeddings is not None else self.embed(documents[start:end])
+            with METRICS.span('upsert_batch'):
+                self._collection.upsert(documents=documents[start:end], embeddings=batch_embeddings.tolist(),
+                                        metadatas=metadatas[start:end], ids=ids[start:end])
+            METRICS.inc('upserted_documents_total', end - start)
+            logger.info(f"Upserted {end}/{total} documents")
+
+    @staticmethod
+    def _write_timestamp(path):
+        # write and rename, so other workers never read a half-written timestamp
+        timestamp = time.time()
+        with open(path + '.tmp', 'w') as f:
+            f.write(str(timestamp))
+        os.replace(path + '.tmp', path)
+        return timestamp
+
+    @staticmethod
+    def _read_timestamp(path):
         try:
-            with open('vector_database/last_updated_time.txt', 'r') as f:
+            with open(path, 'r') as f:
                 return float(f.read())
-        except FileNotFoundError:
+        except (FileNotFoundError, ValueError):
             return False
+
+    def _write_last_updated_time(self):
+        return self._write_timestamp('vector_database/last_updated_time.txt')
+            
+    @staticmethod
+    def read_last_updated_time():
+        return NewsVectorStorage._read_timestamp('vector_database/last_updated_time.txt')
+
+    @staticmethod
+    def read_news_version():
+        """Changes only when an ingest actually inserted, updated or expired articles, unlike the last updated time"""
+        return NewsVectorStorage._read_timestamp('vector_database/news_version.txt')
         
     def are_news_outdated(self):
         '''
         If there is no time saved or the last update was more than 24 hours ago, return True (news are outdated)
         '''
-        last_updated_time = self._read_last_updated_time()
+        last_updated_time = self.read_last_updated_time()
         if last_updated_time:
             return time.time() - last_updated_time > 60 * 60 * 24  # 24 hours
         return True
         
-    def _dataframize_query_results(self, results):
-        flattened_data = []
-        for dist_group, meta_group in zip(results['distances'], results['metadatas']):
-            flattened_data.extend(
-                {'distance': dist, **meta}
-                for dist, meta in zip(dist_group, meta_group)
+    @staticmethod
+    def _fuse_topic_results(results) -> dict:
+        """Flattens the per-topic query results and keeps every article once, with its smallest distance across topics.
+
+        Returns:
+            dict: 'distances' (np.ndarray), 'metadatas' (list) and 'embeddings' (np.ndarray or None), ordered by ascending distance
+        """
+        ids = np.array([id for id_group in results['ids'] for id in id_group], dtype=object)
+        distances = np.array([dist for dist_group in results['distances'] for dist in dist_group], dtype=np.float64)
+        metadatas = [meta for meta_group in results['metadatas'] for meta in meta_group]
+        # stable sort by distance, then the first occurrence of every id is its closest match
+        order = np.argsort(distances, kind='stable')
+        _, first_occurrence = np.unique(ids[order], return_index=True)
+        keep = order[np.sort(first_occurrence)]
+
+        embeddings = None
+        if results.get('embeddings') is not None:
+            embeddings = np.array([emb for emb_group in results['embeddings'] for emb in emb_group], dtype=np.float32)[keep]
+        return {'distances': distances[keep],
+                'metadatas': [metadatas[index] for index in keep],
+                'embeddings': embeddings}
+
+    @staticmethod
+    def _mmr(embeddings: np.ndarray, distances: np.ndarray, k: int, mmr_lambda: float) -> np.ndarray:
+        """Maximal Marginal Relevance: greedily picks k articles trading relevance to the topics (mmr_lambda)
+        against similarity to the articles already picked (1 - mmr_lambda).
+
+        Returns:
+            np.ndarray: indices of the picked articles in picking order
+        """
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        normalized = embeddings / np.where(norms == 0, 1, norms)
+        similarity = normalized @ normalized.T
+        # min-max scale the distances so relevance and similarity live on comparable ranges
+        spread = distances.max() - distances.min()
+        relevance = 1.0 - (distances - distances.min()) / (spread if spread > 0 else 1.0)
+
+        picked = [int(np.argmax(relevance))]
+        available = np.ones(len(distances), dtype=bool)
+        available[picked[0]] = False
+        max_similarity = similarity[picked[0]].copy()
+        while len(picked) < k and available.any():
+            scores = mmr_lambda * relevance - (1.0 - mmr_lambda) * max_similarity
+            scores[~available] = -np.inf
+            next_pick = int(np.argmax(scores))
+            picked.append(next_pick)
+            available[next_pick] = False
+            np.maximum(max_similarity, similarity[next_pick], out=max_similarity)
+        return np.array(picked)
+
+    def per_topic_k(self, n_topics: int, articles_limit=30, oversample=1.5) -> int:
+        """Spreads the articles budget over the topics, oversampled to make up for articles shared by several topics"""
+        per_topic_k = max(math.ceil(articles_limit * oversample / max(n_topics, 1)), self._min_results_per_topic)
+        return min(per_topic_k, self._collection.count())
+
+    def query_topic_results(self, topics: list, per_topic_k: int) -> dict:
+        """Queries the per_topic_k nearest articles of every topic, all topics in one Chroma query.
+
+        Returns:
+            dict: Chroma query results, one list per topic under 'ids', 'distances', 'metadatas' and 'embeddings'
+        """
+        # recurring topics come from the embedding cache
+        query_embeddings = self.embed(topics).tolist()
+        with METRICS.span('vector_query_topics'):
+            return self._collection.query(
+                query_embeddings=query_embeddings,
+                n_results=per_topic_k,
+                # embeddings to collapse near-duplicates and for MMR
+                include=['metadatas', 'distances', 'embeddings']
             )
-        df = pd.DataFrame(flattened_data)
-        df = df.drop_duplicates(subset=['link'])
-        return df
-    
-    def query_topics(self, topics: list, articles_limit = 30):
+
+    def candidates_from_topic_results(self, results: dict, articles_limit=30, mmr_lambda=None) -> Candidates:
+        """Fuses per-topic query results (see query_topic_results) into at most articles_limit candidates,
+        re-ranked with Maximal Marginal Relevance when mmr_lambda is set (needs the embeddings in results).
+        Near-duplicates stored before they could be folded on load are collapsed into the closest one."""
+        if not any(results['ids']):
+            return Candidates()
+        fused = self._fuse_topic_results(results)
+        if fused['embeddings'] is not None:
+            distinct = self._story_clusterer.collapse(fused['embeddings'])
+            fused = {'distances': fused['distances'][distinct],
+                     'metadatas': [fused['metadatas'][index] for index in distinct],
+                     'embeddings': fused['embeddings'][distinct]}
+        if mmr_lambda is not None:
+            selected = self._mmr(fused['embeddings'], fused['distances'], articles_limit, mmr_lambda)
+        else:
+            # already ordered by distance ascending, just limit the number of articles
+            selected = np.arange(min(articles_limit, len(fused['distances'])))
+        return Candidates.from_metadatas([fused['metadatas'][index] for index in selected], fused['distances'][selected].tolist())
+
+    def query_topics(self, topics: list, articles_limit = 30, mmr_lambda=None, oversample=1.5):
         """Retrieves top 30 most recent (or custom number) articles from vector db
         Based on quering by a list of topics that correspond to user interests.
+        The number of results per topic adapts to the number of topics, so the whole budget is used either way.
 
         Args:
             topics (list): list of user interests (e.g. US Presidential Elections)
-            topics_limit (int, optional): maximum # of articles to return. Defaults to 30.
+            articles_limit (int, optional): maximum # of articles to return. Defaults to 30.
+            mmr_lambda (float, optional): when set, re-ranks with Maximal Marginal Relevance, 1 meaning pure relevance
+                and 0 pure diversity. Defaults to None (ordered by distance).
+            oversample (float, optional): how many more candidates than articles_limit to retrieve in total. Defaults to 1.5.
 
         Returns:
-            pandas.DataFrame: returns the query results as a pandas DataFrame with distance, link, domain (of the webpage), published (date) columns
+            Candidates: the articles with their distance, link, domain (of the webpage), published (date), title, summary and alternate sources
         """
-        results = self._collection.query(
-            query_texts=topics,
-            n_results=5
-        )
-        results_df = self._dataframize_query_results(results)
-        results_df.drop_duplicates(subset=['link'], inplace=True)
-        # order by distance ascending and limit the number of articles
-        return results_df.sort_values(by='distance').head(articles_limit)
+        per_topic_k = self.per_topic_k(len(topics), articles_limit, oversample)
+        if per_topic_k == 0 or len(topics) == 0:
+            return Candidates()
+        results = self.query_topic_results(topics, per_topic_k)
+        return self.candidates_from_topic_results(results, articles_limit, mmr_lambda)
     
-    def query_random(self, articles_limit=30, ids_to_exclude=None):
-        """Retrieves top 30 most recent (or custom number) articles from vector db
-        Based on quering by a list of topics that correspond to user interests.
+    def _get_random_id_index(self) -> RandomIdIndex:
+        """Returns the id index for random sampling, rebuilt only when an ingest (possibly by another worker) committed since"""
+        last_updated_time = self.read_last_updated_time()
+        if self._random_id_index is None or last_updated_time != self._random_id_index_version:
+            stored = self._collection.get(include=['metadatas'])
+            self._random_id_index = RandomIdIndex(stored['ids'],
+                                                  [meta.get('published_ts', 0.0) for meta in stored['metadatas']])
+            self._random_id_index_version = last_updated_time
+        return self._random_id_index
+
+    def _refresh_random_id_index(self, upserted_ids: list, upserted_published_ts: list, last_updated_time: float,
+                                 removed_ids=()) -> None:
+        """Applies an ingest to the id index in place instead of rebuilding it from the collection"""
+        if self._random_id_index is None:
+            return
+        self._random_id_index.remove_published_before(time.time() - timedelta(days=self._retention_days).total_seconds())
+        self._random_id_index.remove(list(removed_ids))
+        self._random_id_index.add(upserted_ids, upserted_published_ts)
+        self._random_id_index_version = last_updated_time
+
+    def query_random(self, articles_limit=30, ids_to_exclude=None, recency_half_life_hours=None):
+        """Retrieves random articles (30 or custom number) from vector db, without loading the whole collection.
 
         Args:
-            topics (list): list of user interests (e.g. US Presidential Elections)
-            topics_limit (int, optional): maximum # of articles to return. Defaults to 30.
+            articles_limit (int, optional): maximum # of articles to return. Defaults to 30.
+            ids_to_exclude (list, optional): ids (links) of articles that must not be returned
+            recency_half_life_hours (float, optional): when set, favours recent articles: one published this many hours
+                before the newest is half as likely to be picked. Defaults to None (uniform).
 
         Returns:
-            pandas.DataFrame: returns the query results as a pandas DataFrame with distance, link, domain (of the webpage), published (date) columns
+            Candidates: the articles as in query_topics, with a distance of 0
         """
-        if ids_to_exclude is None:
-            ids_to_exclude = []
-        
-        # retrieve all ids and filter out those that need to be excluded
-        all_ids = self._collection.get()["ids"]
-        filtered_ids = [id for id in all_ids if id not in ids_to_exclude]
-        
-        # if there happens to be less ids than the limit, return all of them
-        if len(filtered_ids) <= articles_limit:
-            sampled_ids = filtered_ids
-        else:
-            sampled_ids = random.sample(filtered_ids, articles_limit)
+        recency_half_life = recency_half_life_hours * 60 * 60 if recency_half_life_hours is not None else None
+        sampled_ids = self._get_random_id_index().sample(articles_limit, exclude=set(ids_to_exclude or ()),
+                                                         recency_half_life=recency_half_life)
+        if not sampled_ids:
+            # an empty id list would make chroma return the whole collection
+            return Candidates()
         
         # retrieve and return the data for the sampled ids
-        results = self._collection.get(ids=sampled_ids)
-        return self.random_to_dataframe(results)
+        with METRICS.span('vector_query_random'):
+            results = self._collection.get(ids=sampled_ids, include=['metadatas'])
+        return Candidates.from_metadatas(results['metadatas'])
     
-    @staticmethod
-    def random_to_dataframe(data_dict):
-        # Create a DataFrame from the 'metadatas' list of dictionaries
-        df = pd.DataFrame(data_dict['metadatas'])
-        df["distance"] = 0 # to keep the same format as the query results
-        return df
-        
\ No newline at end of file
+    def close(self) -> None:
+        self._embedding_engine.close()
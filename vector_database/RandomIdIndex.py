@@ -0,0 +1,125 @@
+import random
+import threading
+from bisect import bisect_right
+from itertools import accumulate
+
+import numpy as np
+
+
+class RandomIdIndex:
+    """In-memory index of the stored article ids for random sampling without touching the vector database.
+
+    Ids live in an array with a position map next to it, so adding and removing one id is O(1) (swap with the
+    last element) and a uniform sample of k ids with exclusions costs O(k + len(exclude)), whatever the
+    collection size. Recency weighted sampling bisects precomputed cumulative weights, O(k log n).
+
+    Args:
+        ids (list, optional): initial article ids
+        published_ts (list, optional): unix publication time of every id, used for recency weighting
+    """
+    def __init__(self, ids=(), published_ts=()) -> None:
+        self._ids = list(ids)
+        self._published_ts = list(published_ts)
+        self._positions = {id: position for position, id in enumerate(self._ids)}
+        self._cumulative_weights = None
+        self._weights_half_life = None
+        self._rng = random.Random()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def __contains__(self, id) -> bool:
+        return id in self._positions
+
+    def add(self, ids: list, published_ts: list) -> None:
+        with self._lock:
+            for id, ts in zip(ids, published_ts):
+                position = self._positions.get(id)
+                if position is None:
+                    self._positions[id] = len(self._ids)
+                    self._ids.append(id)
+                    self._published_ts.append(ts)
+                else:
+                    self._published_ts[position] = ts
+            self._cumulative_weights = None
+
+    def _remove_at(self, position: int) -> None:
+        last_id = self._ids[-1]
+        del self._positions[self._ids[position]]
+        if position != len(self._ids) - 1:
+            self._ids[position] = last_id
+            self._published_ts[position] = self._published_ts[-1]
+            self._positions[last_id] = position
+        self._ids.pop()
+        self._published_ts.pop()
+
+    def remove(self, ids: list) -> None:
+        with self._lock:
+            for id in ids:
+                position = self._positions.get(id)
+                if position is not None:
+                    self._remove_at(position)
+            self._cumulative_weights = None
+
+    def remove_published_before(self, cutoff: float) -> None:
+        """Mirrors the expiry of the vector database, called at ingest time only"""
+        with self._lock:
+            expired = [id for id, ts in zip(self._ids, self._published_ts) if ts < cutoff]
+        self.remove(expired)
+
+    def _weights(self, recency_half_life: float) -> list:
+        if self._cumulative_weights is None or self._weights_half_life != recency_half_life:
+            # relative to the newest article, so the weights never overflow and stay valid as time passes
+            newest = max(self._published_ts)
+            weights = np.exp2((np.asarray(self._published_ts, dtype=np.float64) - newest) / recency_half_life)
+            self._cumulative_weights = list(accumulate(weights.tolist()))
+            self._weights_half_life = recency_half_life
+        return self._cumulative_weights
+
+    def sample(self, k: int, exclude=None, recency_half_life=None) -> list:
+        """Samples up to k distinct ids that are not in exclude.
+
+        Args:
+            k (int): number of ids to return
+            exclude (set, optional): ids that must not be returned
+            recency_half_life (float, optional): when set, an article published this many seconds before the newest
+                one is half as likely to be picked. Uniform sampling when None.
+
+        Returns:
+            list: the sampled ids, fewer than k when the index does not hold enough
+        """
+        exclude = exclude if exclude is not None else set()
+        with self._lock:
+            n = len(self._ids)
+            available = n - sum(1 for id in exclude if id in self._positions)
+            k = min(k, available)
+            if k <= 0:
+                return []
+            if recency_half_life is not None:
+                cumulative_weights = self._weights(recency_half_life)
+                total_weight = cumulative_weights[-1]
+                draw = lambda: min(bisect_right(cumulative_weights, self._rng.random() * total_weight), n - 1)
+            else:
+                draw = lambda: self._rng.randrange(n)
+
+            # rejection sampling stays O(k) while at most half of the available ids are requested
+            if k <= available // 2:
+                sampled, picked = [], set()
+                for _ in range(16 * (k + len(exclude))):
+                    id = self._ids[draw()]
+                    if id in exclude or id in picked:
+                        continue
+                    picked.add(id)
+                    sampled.append(id)
+                    if len(sampled) == k:
+                        return sampled
+
+            # dense request (or unlucky draws under heavy recency skew), filter once instead
+            positions = [position for position, id in enumerate(self._ids) if id not in exclude]
+            if recency_half_life is None:
+                return [self._ids[position] for position in self._rng.sample(positions, k)]
+            cumulative_weights = np.asarray(cumulative_weights)
+            weights = np.maximum(np.diff(cumulative_weights, prepend=0.0)[positions], np.finfo(np.float64).tiny)
+            picked = np.random.default_rng().choice(len(positions), size=k, replace=False, p=weights / weights.sum())
+            return [self._ids[positions[index]] for index in picked]
@@ -0,0 +1,76 @@
+import numpy as np
+
+
+class StoryClusterer:
+    """Finds near-duplicate articles, e.g. the same story carried by several feeds, by cosine similarity of their embeddings.
+
+    Similarities are computed as matrix products over blocks of rows, so the comparisons are vectorized and memory
+    stays at block_size x n floats however many articles come in. Pairs above the threshold are grouped into
+    clusters with a union-find.
+
+    Args:
+        threshold (float, optional): cosine similarity from which two articles are the same story. Defaults to 0.9.
+        block_size (int, optional): rows compared at once. Defaults to 512.
+    """
+    def __init__(self, threshold=0.9, block_size=512) -> None:
+        self.threshold = threshold
+        self._block_size = block_size
+
+    @staticmethod
+    def normalize(embeddings: np.ndarray) -> np.ndarray:
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        return embeddings / np.where(norms == 0, 1, norms)
+
+    def similar_pairs(self, embeddings: np.ndarray) -> np.ndarray:
+        """Returns the (i, j) index pairs, i < j, of the rows at least threshold similar, as an array of shape (pairs, 2)"""
+        normalized = self.normalize(embeddings)
+        pairs = []
+        for start in range(0, len(normalized), self._block_size):
+            similarity = normalized[start:start + self._block_size] @ normalized.T
+            rows, columns = np.nonzero(similarity >= self.threshold)
+            rows += start
+            upper = columns > rows
+            pairs.append(np.stack([rows[upper], columns[upper]], axis=1))
+        return np.concatenate(pairs) if pairs else np.zeros((0, 2), dtype=np.int64)
+
+    @staticmethod
+    def group(keys: list, pairs) -> list:
+        """Connected components of keys linked by (key, key) pairs.
+
+        Returns:
+            list: one list of keys per cluster of more than one key, each in the order of keys
+        """
+        parents = {key: key for key in keys}
+
+        def root(key):
+            while parents[key] != key:
+                # path halving keeps the trees flat
+                parents[key] = parents[parents[key]]
+                key = parents[key]
+            return key
+
+        for first, second in pairs:
+            first_root, second_root = root(first), root(second)
+            if first_root != second_root:
+                parents[second_root] = first_root
+        clusters = {}
+        for key in keys:
+            clusters.setdefault(root(key), []).append(key)
+        return [cluster for cluster in clusters.values() if len(cluster) > 1]
+
+    def collapse(self, embeddings: np.ndarray) -> np.ndarray:
+        """Drops every row that duplicates an earlier one, for rows ordered best first.
+
+        Returns:
+            np.ndarray: indices of the kept rows, in order
+        """
+        if len(embeddings) == 0:
+            return np.arange(0)
+        normalized = self.normalize(embeddings)
+        later_duplicates = np.triu(normalized @ normalized.T >= self.threshold, k=1)
+        keep = np.ones(len(normalized), dtype=bool)
+        for index in range(len(normalized)):
+            if keep[index]:
+                keep[later_duplicates[index]] = False
+        return np.flatnonzero(keep)